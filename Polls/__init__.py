@@ -10,6 +10,8 @@ Add a description of the plugin (to be presented to the user inside the wizard)
 here.  This should describe *what* the plugin does.
 """
 
+import sys
+
 import supybot
 import supybot.world as world
 
@@ -28,11 +30,41 @@ __contributors__ = {}
 __url__ = '' # 'http://supybot.com/Members/yourname/Polls/download'
 
 from . import config
+from . import tally
+from . import schema
+from . import votebuffer
+from . import voterkey
+from . import pollcache
+from . import heapschedule
+from . import announcer
+from . import dbexecutor
+from . import stats
+from . import ratelimit
+from . import live
+from . import export
+from . import deadlines
 from . import plugin
-from imp import reload
+import importlib
 
-reload(config)
-reload(plugin) # In case we're being reloaded.
+importlib.reload(config)
+importlib.reload(tally)
+importlib.reload(schema)
+importlib.reload(votebuffer)
+importlib.reload(voterkey)
+importlib.reload(pollcache)
+importlib.reload(heapschedule)
+importlib.reload(announcer)
+importlib.reload(dbexecutor)
+importlib.reload(stats)
+importlib.reload(ratelimit)
+importlib.reload(live)
+importlib.reload(export)
+importlib.reload(deadlines)
+# imported by plugin.py when a command first needs them, reloaded if they were
+for name in ('tabulate', 'search'):
+    if '%s.%s' % (__name__, name) in sys.modules:
+        importlib.reload(sys.modules['%s.%s' % (__name__, name)])
+importlib.reload(plugin) # In case we're being reloaded.
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
 
@@ -40,6 +72,9 @@ if world.testing:
     from . import test
 
 Class = plugin.Class
+# Owner calls the reload hook of the module of the class before reloading and
+# the one of the package after, see plugin.reload
+reload = plugin.reload
 configure = config.configure
 
 
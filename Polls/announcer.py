@@ -0,0 +1,145 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""One scheduler for the announcements of every active poll."""
+
+import time
+import collections
+
+import supybot.ircmsgs as ircmsgs
+import supybot.ircutils as ircutils
+import supybot.schedule as schedule
+
+from .heapschedule import HeapSchedule, remove_event
+
+
+class Entry(object):
+    """An announcing poll. 'due' is the time.time() of its next announcement"""
+
+    __slots__ = ('irc', 'channel', 'pollid', 'interval', 'due')
+
+    def __init__(self, irc, channel, pollid, interval, due):
+        self.irc = irc
+        self.channel = channel
+        self.pollid = pollid
+        self.interval = interval
+        self.due = due
+
+
+class Announcer(HeapSchedule):
+    """Announces the active polls, each an Entry in the heap of HeapSchedule.
+    Polls of a channel that are due within mergeWindow of each other are
+    announced together.
+
+    announce(irc, channel, pollids) returns the lines to send to channel, the
+    lines are sent no faster than linesPerSecond (after a burst of burst lines)
+    through a second event. Both settings are read with registryValue().
+    job(f) wraps the functions given to supybot schedule, see DbExecutor.job"""
+
+    def __init__(self, announce, registryValue, job=None, name='Polls_announce'):
+        HeapSchedule.__init__(self, job, name)
+        self.announce = announce
+        self.registryValue = registryValue
+        self.lines = collections.deque() # (irc, channel, line) waiting to be sent
+        self.send_event = None  # name of the scheduled send, if there is one
+        self.tokens = float(self.registryValue('announce.burst'))
+        self.refilled = time.time()
+
+    def __contains__(self, key):
+        channel, pollid = key
+        return (ircutils.toLower(channel), pollid) in self.polls
+
+    def _due(self, entry):
+        return entry.due
+
+    def add(self, irc, channel, pollid, interval, due=None):
+        """Announces the poll every 'interval' seconds, the first time at 'due', or right
+        away if it is None. Replaces the schedule of the poll if it already had one"""
+
+        now = due is None
+        if now:
+            due = time.time()
+        key = (ircutils.toLower(channel), pollid)
+        self.polls[key] = Entry(irc, channel, pollid, interval, due)
+        self._push(key, due)
+        if now:
+            self.tick()
+        else:
+            self._schedule()
+
+    def entry(self, channel, pollid):
+        """Returns the Entry of the poll, or None if it isnt being announced"""
+
+        return self.polls.get((ircutils.toLower(channel), pollid))
+
+    def remove(self, channel, pollid):
+        """Stops announcing the poll, returns False if it wasnt being announced"""
+
+        # the heap item stays, it is skipped once it gets to the top
+        return self.polls.pop((ircutils.toLower(channel), pollid), None) is not None
+
+    def tick(self):
+        """Announces every poll that is due, merging those of the same channel"""
+
+        self._cancel()
+
+        now = time.time()
+        groups = collections.OrderedDict() # (irc, lowered channel) -> [Entry, ...]
+        due = self._popDue(now + self.registryValue('announce.mergeWindow'))
+        for key, entry in due:
+            groups.setdefault((entry.irc, key[0]), []).append(entry)
+        # pushed back only once all are popped, see _popDue
+        for key, entry in due:
+            entry.due = now + entry.interval
+            self._push(key, entry.due)
+
+        for entries in groups.values():
+            irc, channel = entries[0].irc, entries[0].channel
+            pollids = sorted(entry.pollid for entry in entries)
+            for line in self.announce(irc, channel, pollids):
+                self.lines.append((irc, channel, line))
+
+        self.send()
+        self._schedule()
+
+    def queue(self, irc, target, lines):
+        """Sends 'lines' to 'target' along with the announcements, within the same rate"""
+
+        for line in lines:
+            self.lines.append((irc, target, line))
+        self.send()
+
+    def send(self):
+        """Sends the waiting lines the budget allows, schedules itself for the rest"""
+
+        remove_event(self.send_event) # we may be run by the event
+        self.send_event = None
+
+        rate = self.registryValue('announce.linesPerSecond')
+        now = time.time()
+        self.tokens = min(float(self.registryValue('announce.burst')),
+                          self.tokens + (now - self.refilled) * rate)
+        self.refilled = now
+        while self.lines and self.tokens >= 1:
+            irc, channel, line = self.lines.popleft()
+            irc.queueMsg(ircmsgs.privmsg(channel, line))
+            self.tokens -= 1
+
+        if self.lines:
+            self.send_event = schedule.addEvent(self.job(self.send), now + (1 - self.tokens) / rate,
+                                                name=self.name + '_send')
+
+    def stop(self):
+        """Removes the scheduled events and forgets every poll"""
+
+        HeapSchedule.stop(self)
+        remove_event(self.send_event)
+        self.send_event = None
+        self.lines.clear()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
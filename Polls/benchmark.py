@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Standalone benchmark for the cost of a vote on a big poll.
+
+Each vote is an INSERT followed by the tally that `vote` sends back to the
+voter. The old tally ran one count(*) per choice, the new one from tally.py
+reads the vote counters that triggers keep on each choice.
+
+    python Polls/benchmark.py [--votes 10000] [--choices 26] [--rounds 200]
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tally
+import schema
+
+
+CHANNEL = '#bench'
+
+
+def make_db(n_votes, n_choices, n_polls=4):
+    """In memory db with 'n_polls' polls of 'n_choices' choices, each with 'n_votes' votes"""
+
+    db = sqlite3.connect(':memory:')
+    schema.migrate(db, CHANNEL)
+    now = datetime.datetime.now()
+    for pollid in range(1, n_polls + 1):
+        db.execute('INSERT INTO polls (channel,id,started_time,isAnnouncing,closed,question) VALUES (?,?,?,?,?,?)',
+                   (CHANNEL, pollid, now, 1, None, 'question %s' % pollid))
+        db.executemany('INSERT INTO choices (channel,poll_id,choice_char,choice) VALUES (?,?,?,?)',
+                       ((CHANNEL, pollid, chr(65 + i), 'answer %s' % i) for i in range(n_choices)))
+        db.executemany('INSERT INTO votes (channel,poll_id,voter_nick,voter_host,choice,time) VALUES (?,?,?,?,?,?)',
+                       ((CHANNEL, pollid, 'nick%s' % i, 'host%s' % i, chr(65 + i % n_choices), now)
+                        for i in range(n_votes)))
+    db.commit()
+    return db
+
+
+def old_tally(cursor, pollid):
+    """The per choice count(*) loop that vote and results used to run"""
+
+    cursor2 = cursor.connection.cursor()
+    cursor.execute('SELECT choice_char,choice FROM choices WHERE channel=? AND poll_id=? ORDER BY choice_char', (CHANNEL, pollid))
+    lines = []
+    for choice_char, choice in cursor.fetchall():
+        cursor2.execute('SELECT count(*) FROM votes WHERE channel=? AND poll_id=? AND choice=?', (CHANNEL, pollid, choice_char))
+        lines.append('%s: %s - %s votes' % (choice_char, choice, cursor2.fetchone()[0]))
+    return lines
+
+
+def new_tally(cursor, pollid):
+    return tally.tally(cursor, CHANNEL, pollid).result_lines()
+
+
+def run(db, tally_func, rounds, n_choices):
+    """Times 'rounds' votes (insert + tally) on poll 1, returns seconds per vote"""
+
+    cursor = db.cursor()
+    now = datetime.datetime.now()
+    start = time.perf_counter()
+    for i in range(rounds):
+        cursor.execute('INSERT INTO votes (channel,poll_id,voter_nick,voter_host,choice,time) VALUES (?,?,?,?,?,?)',
+                       (CHANNEL, 1, 'bench%s' % i, 'benchhost%s' % i, chr(65 + i % n_choices), now))
+        tally_func(cursor, 1)
+    elapsed = time.perf_counter() - start
+    db.rollback()
+    return elapsed / rounds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--votes', type=int, default=10000, help='votes per poll')
+    parser.add_argument('--choices', type=int, default=26, help='choices per poll (max 26)')
+    parser.add_argument('--rounds', type=int, default=200, help='votes to time')
+    args = parser.parse_args(argv)
+
+    db = make_db(args.votes, args.choices)
+    assert old_tally(db.cursor(), 1) == new_tally(db.cursor(), 1)
+
+    print('%s votes, %s choices, %s timed votes' % (args.votes, args.choices, args.rounds))
+    results = {}
+    for name, func in (('per-choice count', old_tally), ('counter tally', new_tally)):
+        results[name] = run(db, func, args.rounds, args.choices)
+        print('%-18s %9.1f us/vote' % (name, results[name] * 1e6))
+    print('speedup            %9.1fx' % (results['per-choice count'] / results['counter tally']))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -17,10 +17,179 @@ def configure(advanced):
     conf.registerPlugin('Polls', True)
 
 
+class Storage(registry.OnlySomeStrings):
+    validStrings = ('channel', 'single')
+
+class VoterIdentity(registry.OnlySomeStrings):
+    validStrings = ('host', 'nickhost', 'account')
+
+class VoteRetention(registry.OnlySomeStrings):
+    validStrings = ('archive', 'delete')
+
+class Hour(registry.NonNegativeInteger):
+    """Value must be an hour of the day, from 0 to 23."""
+    errormsg = 'Value must be an hour of the day from 0 to 23, not %r.'
+    def setValue(self, v):
+        if v > 23:
+            self.error(v)
+        super(Hour, self).setValue(v)
+
+class JournalMode(registry.OnlySomeStrings):
+    validStrings = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+
+class SynchronousLevel(registry.OnlySomeStrings):
+    validStrings = ('off', 'normal', 'full', 'extra')
+
+
 Polls = conf.registerPlugin('Polls')
 # This is where your configuration variables (if any) should go.  For example:
 # conf.registerGlobalValue(Polls, 'someConfigVariableName',
 #     registry.Boolean(False, """Help for someConfigVariableName."""))
 
+conf.registerGlobalValue(Polls, 'dbThread',
+    registry.Boolean(False, """Determines whether the commands and scheduled
+    jobs of this plugin run on a thread of their own, so that slow database
+    work does not hold up the bot. Changes take effect when the plugin is
+    reloaded."""))
+
+conf.registerGlobalValue(Polls, 'storage',
+    Storage('channel', """Determines where the polls are kept. 'channel'
+    uses a database file in the data directory of each channel, 'single'
+    keeps every channel in one Polls.db in the data directory; importdbs.py
+    copies the channel databases into it. Changes take effect when the
+    plugin is reloaded."""))
+
+conf.registerChannelValue(Polls, 'voterIdentity',
+    VoterIdentity('host', """Determines who counts as the same voter. 'host'
+    goes by host, so a nick change does not give another vote. 'nickhost'
+    goes by nick and host, for users sharing a cloak or a bouncer. 'account'
+    goes by the services account when the server tags messages with it,
+    else by the registered bot user, else by host. Votes already cast keep
+    the identity they were cast with."""))
+
+conf.registerGroup(Polls, 'buffer')
+conf.registerGlobalValue(Polls.buffer, 'enable',
+    registry.Boolean(False, """Determines whether votes are kept in memory
+    and written to the database in batches, instead of one commit per
+    vote."""))
+conf.registerGlobalValue(Polls.buffer, 'maxSize',
+    registry.PositiveInteger(100, """Determines how many votes can be
+    buffered before they are written to the database."""))
+conf.registerGlobalValue(Polls.buffer, 'maxAge',
+    registry.PositiveInteger(5, """Determines how many seconds a vote can
+    stay buffered before it is written to the database."""))
+
+conf.registerGroup(Polls, 'throttle')
+conf.registerGlobalValue(Polls.throttle, 'enable',
+    registry.Boolean(True, """Determines whether each nick and each host
+    can only use vote and results at the rate set below. Changes take effect
+    when the plugin is reloaded."""))
+conf.registerGlobalValue(Polls.throttle, 'perMinute',
+    registry.PositiveFloat(6.0, """Determines how many vote and results
+    commands per minute a nick or host can use once its burst is spent."""))
+conf.registerGlobalValue(Polls.throttle, 'burst',
+    registry.PositiveInteger(5, """Determines how many vote and results
+    commands a nick or host can use at once."""))
+conf.registerGlobalValue(Polls.throttle, 'size',
+    registry.PositiveInteger(10000, """Determines how many nicks and hosts
+    are tracked, the least recently seen are forgotten first. Changes take
+    effect when the plugin is reloaded."""))
+
+conf.registerGroup(Polls, 'announce')
+conf.registerGlobalValue(Polls.announce, 'linesPerSecond',
+    registry.PositiveFloat(1.0, """Determines how many lines per second the
+    poll announcements can use, across all channels."""))
+conf.registerGlobalValue(Polls.announce, 'burst',
+    registry.PositiveInteger(4, """Determines how many announcement lines can
+    be sent at once before linesPerSecond applies."""))
+conf.registerGlobalValue(Polls.announce, 'mergeWindow',
+    registry.NonNegativeInteger(60, """Determines how many seconds early a
+    poll can be announced so that it goes out together with the other polls
+    of its channel that are due."""))
+
+conf.registerGroup(Polls, 'live')
+conf.registerChannelValue(Polls.live, 'enable',
+    registry.Boolean(False, """Determines whether vote keeps a running tally
+    of each poll and sends a line of what changed to the subscribers of the
+    poll (see pollwatch) instead of sending every voter the whole results."""))
+conf.registerChannelValue(Polls.live, 'channel',
+    registry.Boolean(False, """Determines whether the changes of the live
+    results are also sent to the channel."""))
+conf.registerGlobalValue(Polls.live, 'delay',
+    registry.NonNegativeInteger(5, """Determines how many seconds the live
+    results wait after a vote, so the votes that come in meanwhile go in the
+    same line."""))
+conf.registerGlobalValue(Polls.live, 'interval',
+    registry.NonNegativeInteger(60, """Determines the minimum number of
+    seconds between two lines of live results for a poll."""))
+
+conf.registerGroup(Polls, 'cache')
+conf.registerGlobalValue(Polls.cache, 'size',
+    registry.PositiveInteger(50, """Determines how many polls of each channel
+    have their question and choices kept in memory. Changes take effect when
+    the plugin is reloaded."""))
+
+conf.registerGroup(Polls, 'stats')
+conf.registerGlobalValue(Polls.stats, 'enable',
+    registry.Boolean(False, """Determines whether the time taken by each SQL
+    statement and command, the rows returned, the commits and the replies
+    are recorded for the pollstats command. Nothing is recorded when off.
+    Changes take effect when the plugin is reloaded."""))
+conf.registerGlobalValue(Polls.stats, 'logInterval',
+    registry.NonNegativeInteger(0, """Determines how many seconds there are
+    between logs of the stats, when they are enabled. 0 disables the logs.
+    Changes take effect when the plugin is reloaded."""))
+
+conf.registerGroup(Polls, 'export')
+conf.registerGlobalValue(Polls.export, 'chunk',
+    registry.PositiveInteger(1000, """Determines how many votes exportpoll
+    reads from the database at a time."""))
+
+conf.registerGroup(Polls, 'retention')
+conf.registerChannelValue(Polls.retention, 'graceDays',
+    registry.NonNegativeInteger(0, """Determines how many days after a poll
+    is closed its votes are rolled up into its final results. Archived polls
+    keep their results but can not be opened again. 0 keeps closed polls as
+    they are."""))
+conf.registerChannelValue(Polls.retention, 'votes',
+    VoteRetention('archive', """Determines whether the votes of archived
+    polls are moved to the Polls-archive.db file next to the database or
+    deleted."""))
+conf.registerGlobalValue(Polls.retention, 'hour',
+    Hour(4, """Determines the hour of the day closed polls are archived at.
+    Changes take effect after the next run."""))
+conf.registerGlobalValue(Polls.retention, 'batch',
+    registry.PositiveInteger(50, """Determines how many polls are archived
+    in a run, the rest are done in runs a minute apart."""))
+
+conf.registerGroup(Polls, 'search')
+conf.registerGlobalValue(Polls.search, 'pageSize',
+    registry.PositiveInteger(10, """Determines how many polls searchpolls
+    shows on a page."""))
+
+conf.registerGroup(Polls, 'sqlite')
+conf.registerGlobalValue(Polls.sqlite, 'journalMode',
+    JournalMode('wal', """Determines the journal mode of the channel
+    databases. In 'wal' mode readers do not block the writer and commits do
+    not need to sync the whole database."""))
+conf.registerGlobalValue(Polls.sqlite, 'synchronous',
+    SynchronousLevel('normal', """Determines how often SQLite waits for
+    data to reach the disk. 'normal' is safe with the 'wal' journal
+    mode."""))
+conf.registerGlobalValue(Polls.sqlite, 'cacheSize',
+    registry.PositiveInteger(2000, """Determines the size in KiB of the page
+    cache of each channel database."""))
+conf.registerGlobalValue(Polls.sqlite, 'mmapSize',
+    registry.NonNegativeInteger(0, """Determines how many bytes of each
+    channel database are memory mapped. 0 disables memory mapping."""))
+conf.registerGlobalValue(Polls.sqlite, 'busyTimeout',
+    registry.NonNegativeInteger(5000, """Determines how many milliseconds to
+    wait for a locked database before giving up."""))
+conf.registerGlobalValue(Polls.sqlite, 'maintenanceInterval',
+    registry.NonNegativeInteger(3600, """Determines how many seconds there
+    are between checkpoints of the write-ahead log and runs of
+    PRAGMA optimize on the open databases. 0 disables them. Changes take
+    effect when the plugin is reloaded."""))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
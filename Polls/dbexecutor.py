@@ -0,0 +1,85 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Runs the database work of the plugin off the bot's main thread."""
+
+import functools
+import concurrent.futures
+
+
+class DbExecutor(object):
+    """A single worker thread that every command and scheduled job touching
+    the dbs (and the in memory state built from them) runs on, one at a time,
+    so that nothing needs locking and a slow query only holds up the plugin.
+    With 'threaded' False everything runs inline on the calling thread"""
+
+    def __init__(self, threaded, log, name='Polls-db'):
+        self.log = log
+        self.pool = None
+        if threaded:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    @property
+    def threaded(self):
+        return self.pool is not None
+
+    def submit(self, f, *args, **kwargs):
+        """Runs f(*args, **kwargs) on the worker thread and returns its Future,
+        or runs it right away if not threaded"""
+
+        if self.pool is None:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(f(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self.pool.submit(f, *args, **kwargs)
+
+    def job(self, f):
+        """Wraps 'f' for supybot schedule: it is run with submit() and errors are logged"""
+
+        @functools.wraps(f)
+        def newf(*args, **kwargs):
+            future = self.submit(f, *args, **kwargs)
+            future.add_done_callback(self._logError)
+        return newf
+
+    def _logError(self, future):
+        e = future.exception()
+        if e is not None:
+            self.log.error('Uncaught exception in db job:', exc_info=(type(e), e, e.__traceback__))
+
+    def shutdown(self):
+        """Waits for the queued work to finish and stops the worker thread"""
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+
+def dbthread(f):
+    """Decorator for commands of a plugin with a 'db_executor', to be applied before wrap.
+    When threaded the command runs on the db thread and replies from there,
+    an exception it raises is logged and reported to the user"""
+
+    @functools.wraps(f)
+    def newf(self, irc, msg, args, *L, **kwargs):
+        if not self.db_executor.threaded:
+            return f(self, irc, msg, args, *L, **kwargs)
+
+        def done(future):
+            e = future.exception()
+            if e is not None:
+                self.log.error('Uncaught exception in %s:' % f.__name__, exc_info=(type(e), e, e.__traceback__))
+                irc.error('An error has occurred and has been logged.')
+
+        self.db_executor.submit(f, self, irc, msg, args, *L, **kwargs).add_done_callback(done)
+    return newf
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
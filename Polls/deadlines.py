@@ -0,0 +1,91 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""One scheduler for the closing time of every poll that has one."""
+
+import re
+import time
+import datetime
+
+import supybot.ircutils as ircutils
+
+from .heapschedule import HeapSchedule
+
+UNITS = {'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+DATE_FORMATS = ('%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse(text, now=None):
+    """Returns the time.time() of 'text', either a duration from 'now' like
+    '90m', '2h30m' or '1w', or a local date and time like '2026-05-01T18:00'.
+    Raises ValueError if it is neither"""
+
+    if now is None:
+        now = time.time()
+    text = text.strip().lower()
+    parts = re.findall(r'(\d+)([wdhms])', text)
+    if parts and ''.join(number + unit for number, unit in parts) == text:
+        return now + sum(int(number) * UNITS[unit] for number, unit in parts)
+    for format in DATE_FORMATS:
+        try:
+            return time.mktime(datetime.datetime.strptime(text.upper(), format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError('%r is not a duration or a date' % text)
+
+
+class Deadlines(HeapSchedule):
+    """Closes the polls that have a deadline, each an (irc, deadline) in the
+    heap of HeapSchedule.
+
+    expire(irc, channel, pollid) is called for each poll once its deadline
+    has passed"""
+
+    def __init__(self, expire, job=None, name='Polls_deadline'):
+        HeapSchedule.__init__(self, job, name)
+        self.expire = expire
+
+    def _due(self, item):
+        return item[1]
+
+    def add(self, irc, channel, pollid, deadline):
+        """Closes the poll at the time.time() 'deadline', replacing the one it had"""
+
+        key = (ircutils.toLower(channel), pollid)
+        self.polls[key] = (irc, deadline)
+        self._push(key, deadline)
+        self._schedule()
+
+    def deadline(self, channel, pollid):
+        """Returns the deadline of the poll, or None if it has none"""
+
+        item = self.polls.get((ircutils.toLower(channel), pollid))
+        return item and item[1]
+
+    def remove(self, channel, pollid):
+        """Drops the deadline of the poll, returns False if it had none"""
+
+        # the heap item stays, it is skipped once it gets to the top
+        if self.polls.pop((ircutils.toLower(channel), pollid), None) is None:
+            return False
+        self._schedule()
+        return True
+
+    def tick(self):
+        """Expires every poll whose deadline has passed"""
+
+        self._cancel()
+        for key, item in self._popDue(time.time()):
+            # an earlier expire can have changed it
+            if self.polls.get(key) is item:
+                del self.polls[key]
+                self.expire(item[0], key[0], key[1])
+        self._schedule()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -0,0 +1,83 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Writes a poll, its choices with their tallies and its raw votes as CSV or
+JSON lines, a chunk of rows at a time so memory use does not grow with the
+number of votes."""
+
+import csv
+import json
+
+try:
+    from . import tally
+except ImportError:
+    import tally # imported by exportpoll.py from the plugin directory
+
+FORMATS = ('csv', 'jsonl')
+
+# every record has the same fields, 'record' says which of them are set
+FIELDS = ('record', 'channel', 'poll_id', 'question', 'started_time', 'closed',
+          'choice', 'text', 'votes', 'voter_nick', 'voter_host', 'time')
+
+POLL_QUERY = """SELECT question, started_time, closed FROM polls
+                WHERE channel=? AND id=?"""
+
+VOTES_QUERY = """SELECT voter_nick, voter_host, choice, time FROM votes
+                 WHERE channel=? AND poll_id=?"""
+
+
+class CsvWriter(object):
+    def __init__(self, fd):
+        self.writer = csv.writer(fd)
+        self.writer.writerow(FIELDS)
+
+    def write(self, record):
+        self.writer.writerow([record.get(field, '') for field in FIELDS])
+
+
+class JsonLinesWriter(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, record):
+        self.fd.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+
+
+def write(db, channel, pollid, fd, format='csv', chunk=1000):
+    """Writes the poll 'pollid' of the lowercase 'channel' from 'db' to the text
+    file 'fd' in 'format' (one of FORMATS). The votes are fetched 'chunk' rows
+    at a time from one cursor. Returns the number of votes written, raises
+    ValueError if the poll doesnt exist"""
+
+    cursor = db.cursor()
+    cursor.execute(POLL_QUERY, (channel, pollid))
+    poll = cursor.fetchone()
+    if poll is None:
+        raise ValueError('No poll #%s in %s' % (pollid, channel))
+
+    writer = CsvWriter(fd) if format == 'csv' else JsonLinesWriter(fd)
+    question, started_time, closed = poll
+    writer.write({'record': 'poll', 'channel': channel, 'poll_id': pollid, 'question': question,
+                  'started_time': started_time, 'closed': closed})
+
+    for choice, text, votes in tally.tally(cursor, channel, pollid):
+        writer.write({'record': 'choice', 'channel': channel, 'poll_id': pollid,
+                      'choice': choice, 'text': text, 'votes': votes})
+
+    written = 0
+    cursor.execute(VOTES_QUERY, (channel, pollid))
+    rows = cursor.fetchmany(chunk)
+    while rows:
+        for nick, host, choice, time in rows:
+            writer.write({'record': 'vote', 'channel': channel, 'poll_id': pollid, 'choice': choice,
+                          'voter_nick': nick, 'voter_host': host, 'time': time})
+        written += len(rows)
+        rows = cursor.fetchmany(chunk)
+    return written
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
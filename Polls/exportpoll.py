@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Exports a poll from a Polls database as CSV or JSON lines.
+
+Reads the db file directly, so it works on a copy or while the bot runs
+(the db is opened read only). Writes to standard output unless --output
+is given.
+
+    python Polls/exportpoll.py data/#channel/Polls.db '#channel' 3 [--format jsonl] [--output poll3.jsonl]
+"""
+
+import os
+import sys
+import sqlite3
+import argparse
+import urllib.parse
+
+import supybot.ircutils as ircutils
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import export
+import schema
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('db', help='the Polls.db file')
+    parser.add_argument('channel', help='the channel of the poll')
+    parser.add_argument('pollid', type=int, help='the poll id')
+    parser.add_argument('--format', choices=export.FORMATS, default='csv')
+    parser.add_argument('--output', help='file to write, standard output by default')
+    parser.add_argument('--chunk', type=int, default=1000, help='votes fetched at a time')
+    args = parser.parse_args(argv)
+
+    # quoted, the # of a channel directory would start the fragment of the uri
+    db = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(args.db)), uri=True)
+    if schema.version(db) != schema.VERSION:
+        parser.exit(1, '%s is at schema version %s, load it with the plugin first to upgrade it to %s\n' %
+                    (args.db, schema.version(db), schema.VERSION))
+
+    # checked before --output is opened, so a wrong poll id leaves the file alone
+    channel = ircutils.toLower(args.channel)
+    if db.execute(export.POLL_QUERY, (channel, args.pollid)).fetchone() is None:
+        parser.exit(1, 'No poll #%s in %s\n' % (args.pollid, channel))
+
+    fd = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        votes = export.write(db, channel, args.pollid, fd, args.format, args.chunk)
+    finally:
+        if args.output:
+            fd.close()
+    sys.stderr.write('%s votes exported\n' % votes)
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -0,0 +1,108 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""The heap and single schedule event shared by the announcer and the deadlines."""
+
+import abc
+import heapq
+
+import supybot.schedule as schedule
+
+
+def remove_event(name):
+    """Removes the supybot schedule event 'name' if there is one. An event
+    being run, or that ran already, is not there any more"""
+
+    if name is not None:
+        try:
+            schedule.removeEvent(name)
+        except KeyError:
+            pass
+
+
+class HeapSchedule(object, metaclass=abc.ABCMeta):
+    """Keeps the polls in a heap ordered by when they are due and runs a single
+    supybot.schedule event, tick(), for the earliest one.
+
+    Subclasses keep an item for each poll in self.polls and say when it is due
+    with _due(item). job(f) wraps the functions given to supybot schedule, see
+    DbExecutor.job"""
+
+    def __init__(self, job=None, name=None):
+        self.job = job or (lambda f: f)
+        self.name = name
+        self.polls = {}  # (lowered channel, pollid) -> item
+        self.heap = []   # (due, lowered channel, pollid), stale items are skipped when popped
+        self.event = None       # name of the scheduled tick, if there is one
+        self.event_time = None  # when it will run
+
+    def __len__(self):
+        return len(self.polls)
+
+    @abc.abstractmethod
+    def _due(self, item):
+        """Returns the time.time() 'item' is due"""
+
+    @abc.abstractmethod
+    def tick(self):
+        """Run by the scheduled event, handles the polls that are due and calls _schedule"""
+
+    def _push(self, key, due):
+        """Puts the poll 'key' in the heap, due at 'due'. It is skipped if its item says otherwise by then"""
+
+        heapq.heappush(self.heap, (due, key[0], key[1]))
+
+    def _cancel(self):
+        """Forgets the scheduled tick, tick does it first"""
+
+        remove_event(self.event)
+        self.event = self.event_time = None
+
+    def _popDue(self, until):
+        """Takes the polls due by 'until' out of the heap, returns [(key, item), ...] earliest
+        first. Those to run again are pushed back by the caller once it is done with all of
+        them, so nothing popped is popped again by the same tick"""
+
+        due = []
+        while self.heap and self.heap[0][0] <= until:
+            when, channel, pollid = heapq.heappop(self.heap)
+            item = self.polls.get((channel, pollid))
+            if item is not None and self._due(item) == when:
+                due.append(((channel, pollid), item))
+        return due
+
+    def _schedule(self):
+        """Makes the tick event run when the earliest poll is due"""
+
+        while self.heap:
+            when, channel, pollid = self.heap[0]
+            item = self.polls.get((channel, pollid))
+            if item is not None and self._due(item) == when:
+                break
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            self._cancel()
+            return
+
+        when = self.heap[0][0]
+        if self.event is not None:
+            if self.event_time == when:
+                return
+            self._cancel()
+        self.event = schedule.addEvent(self.job(self.tick), when, name=self.name)
+        self.event_time = when
+
+    def stop(self):
+        """Removes the scheduled event and forgets every poll"""
+
+        self._cancel()
+        self.polls.clear()
+        del self.heap[:]
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
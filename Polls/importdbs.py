@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Copies the per channel Polls databases into the single one.
+
+Every data/<channel>/Polls.db is upgraded in place, then its polls, choices
+and votes are copied into data/Polls.db, which is what the plugin uses with
+supybot.plugins.Polls.storage set to 'single'. Channels already in the target
+are skipped, so the script can be run again after an interruption. Unload the
+plugin (or stop the bot) while it runs.
+
+    python Polls/importdbs.py <data directory> [--batch 5000]
+"""
+
+import os
+import sys
+import sqlite3
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import schema
+
+
+FILENAME = 'Polls.db'
+
+
+def channel_dbs(datadir):
+    """Returns [(channel, path), ...] of the per channel dbs in 'datadir'.
+    The directory names are the channels, already lowercase"""
+
+    dbs = []
+    for name in sorted(os.listdir(datadir)):
+        path = os.path.join(datadir, name, FILENAME)
+        if os.path.isfile(path):
+            dbs.append((name, path))
+    return dbs
+
+
+def import_channel(db, channel, path, batch):
+    """Copies the db of 'channel' at 'path' into 'db', the votes 'batch' rows
+    per transaction. Returns the number of polls and votes copied"""
+
+    source = sqlite3.connect(path)
+    try:
+        schema.migrate(source, channel)
+    finally:
+        source.close()
+
+    db.execute('ATTACH DATABASE ? AS source', (path,))
+    try:
+        # votes left by an interrupted run. they go first and the choices
+        # after them, so the count triggers have nothing to update
+        db.execute('BEGIN')
+        db.execute('DELETE FROM votes WHERE channel=?', (channel,))
+        db.execute('COMMIT')
+
+        last = votes = 0
+        while True:
+            db.execute('BEGIN')
+            cursor = db.execute("""INSERT INTO votes (channel,poll_id,voter_key,voter_nick,voter_host,choice,previous_choice,time)
+                                   SELECT ?,poll_id,voter_key,voter_nick,voter_host,choice,previous_choice,time FROM source.votes
+                                   WHERE id > ? ORDER BY id LIMIT ?""", (channel, last, batch))
+            copied = cursor.rowcount
+            if copied:
+                last = db.execute('SELECT max(id) FROM (SELECT id FROM source.votes WHERE id > ? ORDER BY id LIMIT ?)',
+                                  (last, batch)).fetchone()[0]
+            db.execute('COMMIT')
+            votes += copied
+            if copied < batch:
+                break
+
+        # the polls go in last, a channel with polls in the target is done
+        db.execute('BEGIN')
+        db.execute("""INSERT INTO choices (channel,poll_id,choice_char,choice,votes)
+                      SELECT ?,poll_id,choice_char,choice,votes FROM source.choices""", (channel,))
+        db.execute("""INSERT INTO poll_summary (channel,poll_id,choice_char,choice,votes)
+                      SELECT ?,poll_id,choice_char,choice,votes FROM source.poll_summary""", (channel,))
+        polls = db.execute("""INSERT INTO polls (channel,id,started_time,isAnnouncing,closed,question,announce_interval,next_announce,archived,kind,outcome,deadline)
+                              SELECT ?,id,started_time,isAnnouncing,closed,question,announce_interval,next_announce,archived,kind,outcome,deadline
+                              FROM source.polls""", (channel,)).rowcount
+        db.execute('COMMIT')
+    except Exception:
+        if db.in_transaction:
+            db.rollback()
+        raise
+    finally:
+        db.execute('DETACH DATABASE source')
+    return polls, votes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('datadir', help='the data directory of the bot')
+    parser.add_argument('--batch', type=int, default=5000, help='votes copied per transaction')
+    args = parser.parse_args(argv)
+
+    db = sqlite3.connect(os.path.join(args.datadir, FILENAME), isolation_level=None)
+    schema.migrate(db)
+    done = set(row[0] for row in db.execute('SELECT DISTINCT channel FROM polls'))
+
+    for channel, path in channel_dbs(args.datadir):
+        if channel in done:
+            print('%s: already imported' % channel)
+            continue
+        polls, votes = import_channel(db, channel, path, args.batch)
+        print('%s: %s polls, %s votes' % (channel, polls, votes))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
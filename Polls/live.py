@@ -0,0 +1,152 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Running tallies of the polls being voted on, pushed as they change."""
+
+import time
+
+import supybot.ircutils as ircutils
+import supybot.schedule as schedule
+
+from .heapschedule import remove_event
+
+
+class LivePoll(object):
+    """Vote counts of a poll as of now and as of the last push"""
+
+    __slots__ = ('irc', 'channel', 'pollid', 'counts', 'pushed', 'last_push', 'event')
+
+    def __init__(self, irc, channel, pollid, counts):
+        self.irc = irc
+        self.channel = channel
+        self.pollid = pollid
+        self.counts = counts        # choice char -> votes, in choice order
+        self.pushed = dict(counts)  # the same as of the last push
+        self.last_push = 0.0
+        self.event = None           # name of the scheduled push, if there is one
+
+    def changes(self):
+        """The summary of what changed since the last push, None if nothing did"""
+
+        changed = ['%s %+d (%s)' % (c, n - self.pushed.get(c, 0), n)
+                   for c, n in self.counts.items() if n != self.pushed.get(c, 0)]
+        if not changed:
+            return None
+        return 'Poll #%s: %s | %s votes' % (self.pollid, ', '.join(changed), sum(self.counts.values()))
+
+
+class LiveResults(object):
+    """Keeps a running tally of each poll voted on and pushes a line of the
+    changes to the channel and the subscribers of the poll. A push waits
+    'live.delay' seconds after the first vote so votes coming together go in
+    one line, and pushes of a poll are at least 'live.interval' seconds apart.
+
+    queue(irc, target, lines) sends the lines, see Announcer.queue. job(f) wraps
+    the functions given to supybot schedule, see DbExecutor.job"""
+
+    def __init__(self, queue, registryValue, job=None, name='Polls_live'):
+        self.queue = queue
+        self.registryValue = registryValue
+        self.job = job or (lambda f: f)
+        self.name = name
+        self.polls = {}       # (lowered channel, pollid) -> LivePoll
+        self.subscribers = {} # (lowered channel, pollid) -> IrcSet of nicks
+
+    def __len__(self):
+        return len(self.polls)
+
+    def vote(self, irc, channel, pollid, old, new, load):
+        """Moves a vote from choice 'old' (None for a new vote) to 'new'. The
+        poll is loaded with load(), a tally.Tally that already has the vote,
+        the first time"""
+
+        key = (ircutils.toLower(channel), pollid)
+        poll = self.polls.get(key)
+        if poll is None:
+            counts = dict((c, n or 0) for c, text, n in load())
+            poll = self.polls[key] = LivePoll(irc, channel, pollid, counts)
+            # as if the vote came after the last push, so it goes in the next one
+            poll.pushed[new] -= 1
+            if old is not None:
+                poll.pushed[old] += 1
+        else:
+            poll.counts[new] += 1
+            if old is not None:
+                poll.counts[old] -= 1
+        self._schedule(key, poll)
+
+    def _schedule(self, key, poll):
+        if poll.event is not None:
+            return
+        due = max(time.time() + self.registryValue('live.delay'),
+                  poll.last_push + self.registryValue('live.interval'))
+        poll.event = schedule.addEvent(self.job(lambda: self.push(key)), due,
+                                       name='%s_%s_%s' % (self.name, key[0], key[1]))
+
+    def push(self, key):
+        """Sends the changes of a poll, run by its scheduled event"""
+
+        poll = self.polls.get(key)
+        if poll is None:
+            return
+        remove_event(poll.event) # we may be run by the event
+        poll.event = None
+        line = poll.changes()
+        if line is None:
+            return
+        poll.pushed = dict(poll.counts)
+        poll.last_push = time.time()
+        if self.registryValue('live.channel', poll.channel):
+            self.queue(poll.irc, poll.channel, [line])
+        for nick in self.subscribers.get(key, ()):
+            self.queue(poll.irc, nick, [line])
+
+    def subscribe(self, channel, pollid, nick):
+        """Toggles the subscription of 'nick' to the poll, returns whether they are subscribed now"""
+
+        nicks = self.subscribers.setdefault((ircutils.toLower(channel), pollid), ircutils.IrcSet())
+        if nick in nicks:
+            nicks.remove(nick)
+            return False
+        nicks.add(nick)
+        return True
+
+    def add(self, irc, channel, pollid, counts, pushed, last_push):
+        """Takes over the running tally of a poll from another instance, as
+        of 'counts' now and 'pushed' at the last push. Pending changes are
+        pushed as usual"""
+
+        key = (ircutils.toLower(channel), pollid)
+        poll = self.polls[key] = LivePoll(irc, channel, pollid, counts)
+        poll.pushed = pushed
+        poll.last_push = last_push
+        if poll.changes() is not None:
+            self._schedule(key, poll)
+
+    def reset(self, channel, pollid):
+        """Drops the running tally of a poll, it is loaded again by the next vote.
+        Pending changes are not sent, the subscribers stay"""
+
+        poll = self.polls.pop((ircutils.toLower(channel), pollid), None)
+        if poll is not None:
+            remove_event(poll.event)
+
+    def forget(self, channel, pollid):
+        """Drops the running tally and subscribers of a poll, pending changes are not sent"""
+
+        self.subscribers.pop((ircutils.toLower(channel), pollid), None)
+        self.reset(channel, pollid)
+
+    def stop(self):
+        """Removes the scheduled pushes and forgets every poll"""
+
+        for channel, pollid in list(self.polls):
+            self.forget(channel, pollid)
+        self.subscribers.clear()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -0,0 +1,208 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Load tests that drive the plugin through the test bot with synthetic vote
+storms and report throughput, latency, SQL statements and db growth.
+
+They are skipped unless POLLS_LOADTEST names the JSON file for the results:
+
+    POLLS_LOADTEST=before.json supybot-test Polls
+    POLLS_LOADTEST=after.json POLLS_LOADTEST_BASELINE=before.json supybot-test Polls
+
+POLLS_LOADTEST_SCALE (default 1) multiplies the size of every scenario."""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import platform
+
+from supybot.test import *
+
+
+def percentile(values, p):
+    """The 'p'th percentile of 'values' by the nearest rank"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Recorder(object):
+    """Timings and SQL statement counts of one scenario. The statements are
+    counted with the trace callback of every db connection of the plugin"""
+
+    def __init__(self, cb):
+        self.cb = cb
+        self.latencies = {} # command name -> [seconds, ...]
+        self.statements = 0
+        self.traced = set()
+        self.sizes = self._sizes()
+        self.elapsed = 0.0
+
+    def _count(self, statement):
+        self.statements += 1
+
+    def trace(self):
+        """Counts the statements of the connections opened since the last call"""
+        for db in self.cb.db_files.values():
+            if id(db) not in self.traced:
+                db.set_trace_callback(self._count)
+                self.traced.add(id(db))
+
+    def _sizes(self):
+        """Bytes on disk of each db file with its write-ahead log"""
+        sizes = {}
+        for filename in self.cb.db_files:
+            sizes[filename] = sum(os.path.getsize(f) for f in (filename, filename + '-wal') if os.path.exists(f))
+        return sizes
+
+    def time(self, name, f, *args):
+        """Runs f(*args) and records how long it took under 'name'"""
+        self.trace()
+        start = time.perf_counter()
+        f(*args)
+        elapsed = time.perf_counter() - start
+        self.elapsed += elapsed
+        self.latencies.setdefault(name, []).append(elapsed)
+
+    def report(self):
+        self.trace()
+        sizes = self._sizes()
+        commands = sum(len(values) for values in self.latencies.values())
+        for db in self.cb.db_files.values():
+            db.set_trace_callback(None)
+        return {
+            'commands': commands,
+            'seconds': round(self.elapsed, 4),
+            'throughput': round(commands / self.elapsed, 1) if self.elapsed else None,
+            'statements': self.statements,
+            'statements_per_command': round(float(self.statements) / commands, 2) if commands else None,
+            'db_growth': sum(sizes.values()) - sum(self.sizes.get(f, 0) for f in sizes),
+            'latency_ms': dict((name, {'count': len(values),
+                                       'p50': round(percentile(values, 50) * 1000, 3),
+                                       'p99': round(percentile(values, 99) * 1000, 3)})
+                               for name, values in self.latencies.items()),
+        }
+
+
+class PollsLoadTestCase(ChannelPluginTestCase):
+    plugins = ('Polls',)
+    results = {}
+    output = os.environ.get('POLLS_LOADTEST')
+    scale = float(os.environ.get('POLLS_LOADTEST_SCALE', 1))
+
+    def setUp(self):
+        if not self.output:
+            self.skipTest('set POLLS_LOADTEST to the file for the results to run the load tests')
+        ChannelPluginTestCase.setUp(self)
+        self.cb = self.irc.getCallback('Polls')
+        self.recorder = Recorder(self.cb)
+
+    @classmethod
+    def tearDownClass(cls):
+        if not cls.results or not cls.output:
+            return
+        data = {'scale': cls.scale, 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scenarios': cls.results}
+        with open(cls.output, 'w') as fd:
+            json.dump(data, fd, indent=2, sort_keys=True)
+        baseline = os.environ.get('POLLS_LOADTEST_BASELINE')
+        if baseline:
+            with open(baseline) as fd:
+                cls._compare(json.load(fd)['scenarios'], cls.results)
+
+    @staticmethod
+    def _compare(before, after):
+        """Prints the throughput and p99 of each command against a previous run"""
+        for name in sorted(after):
+            if name not in before:
+                continue
+            old, new = before[name], after[name]
+            if old['throughput'] and new['throughput']:
+                sys.stderr.write('%s: %.2fx throughput\n' % (name, new['throughput'] / old['throughput']))
+            for command, latency in sorted(new['latency_ms'].items()):
+                if command in old['latency_ms'] and old['latency_ms'][command]['p99']:
+                    sys.stderr.write('  %s p99 %.3f -> %.3f ms\n' % (command, old['latency_ms'][command]['p99'], latency['p99']))
+
+    def _n(self, n):
+        return max(1, int(n * self.scale))
+
+    def _command(self, query, to=None, frm=None):
+        """Feeds a command and throws away what the bot sends back, failing on errors"""
+        self.feedMsg('@' + query, to=to, frm=frm)
+        m = self.irc.takeMsg()
+        while m is not None:
+            self.assertNotIn('Error:', m.args[1], query)
+            m = self.irc.takeMsg()
+
+    def _timed(self, query, to=None, frm=None):
+        self.recorder.time(query.split()[0], self._command, query, to, frm)
+
+    def _voter(self, i):
+        return 'voter%s!user%s@host%s.example' % (i, i, i)
+
+    def _record(self, name):
+        self.results[name] = self.recorder.report()
+
+    def _storm(self, name):
+        self._command('newpoll 5 "yes,no,maybe,never" Storm?')
+        for i in range(self._n(10000)):
+            self._timed('vote 1 %s' % 'abcd'[i % 4], frm=self._voter(i))
+        self._timed('results 1', frm=self._voter(0))
+        if self.cb.vote_buffer:
+            self.recorder.time('flush', self.cb._flushVotes)
+        self._record(name)
+
+    def testVoteStorm(self):
+        with conf.supybot.abuse.flood.command.context(False):
+            self._storm('vote_storm')
+
+    def testBufferedVoteStorm(self):
+        with conf.supybot.abuse.flood.command.context(False):
+            with conf.supybot.plugins.Polls.buffer.enable.context(True):
+                self._storm('buffered_vote_storm')
+
+    def testManyChannels(self):
+        channels = ['#load%s' % i for i in range(self._n(20))]
+        polls = 5
+        with conf.supybot.abuse.flood.command.context(False):
+            for channel in channels:
+                for pollid in range(polls):
+                    self._timed('newpoll %s 5 "yes,no" Poll %s?' % (channel, pollid))
+            for i in range(self._n(5000)):
+                channel = channels[i % len(channels)]
+                self._timed('vote %s %s' % ((i // len(channels)) % polls + 1, 'ab'[i % 2]),
+                            to=channel, frm=self._voter(i))
+        self._record('many_channels')
+
+    def testOpenPolls(self):
+        with conf.supybot.abuse.flood.command.context(False):
+            for i in range(self._n(300)):
+                self._command('newpoll 5 "yes,no,maybe,never,always" Question %s?' % i)
+            for i in range(20):
+                self._timed('openpolls')
+        self._record('openpolls')
+
+    def testAnnouncerTick(self):
+        with conf.supybot.abuse.flood.command.context(False):
+            with conf.supybot.plugins.Polls.announce.burst.context(1000000):
+                n = self._n(500)
+                for i in range(n):
+                    self._command('newpoll 5 "yes,no,maybe" Question %s?' % i)
+                self.assertEqual(len(self.cb.announcer), n)
+                for i in range(10):
+                    for entry in self.cb.announcer.polls.values():
+                        entry.due = 0
+                    self.cb.announcer.heap = [(0, channel, pollid) for channel, pollid in self.cb.announcer.polls]
+                    self.cb.announcer.tokens = 1000000
+                    self.recorder.time('tick', self.cb.announcer.tick)
+                    while self.irc.takeMsg() is not None:
+                        pass
+        self._record('announcer_tick')
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -8,68 +8,394 @@
 import supybot.conf as conf
 import supybot.utils as utils
 import supybot.ircdb as ircdb
-from supybot.commands import *
+from supybot.commands import wrap, getopts, optional, additional, commalist, many
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
 
 import os
-import traceback
+import time
+import sqlite3
 import datetime
-import supybot.ircmsgs as ircmsgs
 import supybot.schedule as schedule
 
-try:
-    import sqlite3
-except ImportError:
-    from pysqlite2 import dbapi2 as sqlite3 # for python2.4
-
+from . import tally
+from . import schema
+from . import votebuffer
+from . import voterkey
+from . import pollcache
+from . import announcer
+from . import dbexecutor
+from . import stats
+from . import ratelimit
+from . import live
+from . import export
+from . import deadlines
+from .dbexecutor import dbthread
+from .heapschedule import remove_event
+from .stats import timed
+from .ratelimit import throttled
+# tabulate and search are imported by the commands that use them, the
+# export thread imports threading
 
 class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
     """Poll for in channel
     Make polls and people can vote on them"""
 
+    # the dict an instance unloaded for a reload leaves its state in for the next one, set on
+    # the old and the new class by the reload hook at the end of this module, None otherwise
+    handover = None
+
     def __init__(self, irc):
         """run the usual init from parents"""
         callbacks.Plugin.__init__(self, irc)
         plugins.ChannelDBHandler.__init__(self)
-        self.poll_schedules = [] # stores the current polls that are scheduled, so that on unload we can remove them
+        # 'channel' keeps a db file per channel, 'single' one file for every channel
+        self.storage = self.registryValue('storage')
+        # runs commands and scheduled jobs on the db thread when dbThread is on, else inline
+        self.db_executor = dbexecutor.DbExecutor(self.registryValue('dbThread'), self.log)
+        # announces every active poll, stopped on unload
+        self.announcer = announcer.Announcer(self._announce, self.registryValue, job=self.db_executor.job)
+        # closes the polls that have a deadline when it passes, stopped on unload
+        self.deadlines = deadlines.Deadlines(self._expirePoll, job=self.db_executor.job)
+
+        # announcing polls are restored from each db file the first time it is opened. the ones
+        # not opened by a command are restored a few at a time by the restore event. on a reload
+        # the files the old instance had open are handed over with their polls, see die
+        self.restore_irc = irc
+        self.db_files = {} # filename -> connection, several channels share one with the single storage
+        state = self._takeHandover()
+        if state is not None:
+            self.db_files.update(state['db_files'])
+            self.dbCache.update(state['dbCache'])
+        self.unrestored = self._existingDbs()
+        for filename in self.db_files:
+            self.unrestored.pop(filename, None)
+        self.restore_event = None
+        if self.unrestored:
+            self.restore_event = schedule.addEvent(self.db_executor.job(self._restoreSchedules), time.time(), name='Polls_restore')
+        self.vote_buffer = votebuffer.VoteBuffer() # votes waiting to be written when buffer.enable is on
+        self.flush_event = None # name of the scheduled flush of vote_buffer, if there is one
+        self.poll_cache = pollcache.PollCache(self.registryValue('cache.size'))
+        # running tallies pushed to subscribers when live.enable is on, sent at the announcement rate
+        self.live = live.LiveResults(self.announcer.queue, self.registryValue, job=self.db_executor.job)
+        # token buckets for vote and results, None when throttling is off
+        self.limiter = None
+        if self.registryValue('throttle.enable'):
+            self.limiter = ratelimit.RateLimiter(self.registryValue('throttle.size'))
+
+        # timings and counters for pollstats, None when stats are off so nothing is recorded
+        self.stats = None
+        self.stats_event = None # name of the periodic _logStats event
+        if self.registryValue('stats.enable'):
+            self.stats = stats.Stats()
+            log_interval = self.registryValue('stats.logInterval')
+            if log_interval:
+                self.stats_event = schedule.addPeriodicEvent(self.db_executor.job(self._logStats), log_interval, name='Polls_stats', now=False)
+
+        self.maintenance_event = None # name of the periodic _maintainDbs event
+        maintenance_interval = self.registryValue('sqlite.maintenanceInterval')
+        if maintenance_interval:
+            self.maintenance_event = schedule.addPeriodicEvent(self.db_executor.job(self._maintainDbs), maintenance_interval,
+                                                               name='Polls_maintenance', now=False)
+
+        # closed polls are rolled up once a day at retention.hour, see _archivePolls
+        self.archive_event = schedule.addEvent(self.db_executor.job(self._archivePolls), self._nextArchive(), name='Polls_archive')
+
+        if state is not None:
+            self._resume(state)
+
+    def _handOver(self):
+        """Run on the db thread by die on a reload, returns what the next instance takes over.
+        The buffered votes are not written, the scheduled events are removed by die"""
+
+        remove_event(self.flush_event)
+        self.flush_event = None
+        return {'storage': self.storage,
+                'db_files': dict(self.db_files),
+                'dbCache': dict(self.dbCache),
+                'votes': self.vote_buffer.take(),
+                'announcements': [(entry.irc, entry.channel, entry.pollid, entry.interval, entry.due)
+                                  for entry in self.announcer.polls.values()],
+                'lines': list(self.announcer.lines),
+                'deadlines': [(irc, channel, pollid, deadline)
+                              for (channel, pollid), (irc, deadline) in self.deadlines.polls.items()],
+                'subscribers': dict(self.live.subscribers),
+                'live': [(poll.irc, poll.channel, poll.pollid, poll.counts, poll.pushed, poll.last_push)
+                         for poll in self.live.polls.values()]}
+
+    def _takeHandover(self):
+        """Returns what the instance unloaded for a reload left, or None. Its connections are
+        closed if the storage changed, the polls are then restored from the new files"""
+
+        state, self.__class__.handover = self.handover, None
+        if not state:
+            return None
+        if state['storage'] != self.storage:
+            for db in state['db_files'].values():
+                db.close()
+            state['db_files'] = state['dbCache'] = {}
+        return state
+
+    def _resume(self, state):
+        """Schedules again what was handed over by the instance unloaded for a reload, once"""
+
+        for irc, channel, pollid, interval, due in state['announcements']:
+            self.announcer.add(irc, channel, pollid, interval, due=due)
+        for irc, channel, pollid, deadline in state['deadlines']:
+            self.deadlines.add(irc, channel, pollid, deadline)
+        for irc, target, line in state['lines']:
+            self.announcer.queue(irc, target, [line])
+        self.live.subscribers.update(state['subscribers'])
+        for irc, channel, pollid, counts, pushed, last_push in state['live']:
+            self.live.add(irc, channel, pollid, counts, pushed, last_push)
+        for channel, pending in state['votes']:
+            for vote in pending:
+                self.vote_buffer.add(channel, vote)
+        if self.vote_buffer:
+            self.flush_event = schedule.addEvent(self.db_executor.job(self._flushVotes), time.time() + self.registryValue('buffer.maxAge'),
+                                                 name='Polls_flush_votes')
+
+    def getDb(self, channel):
+        """ Returns the db connection for 'channel'. Unlike ChannelDBHandler, the connection
+        is kept whatever thread asks for it, the db thread makes sure only one thread uses it at a time"""
+
+        db = self.dbCache.get(channel)
+        if db is None:
+            db = self.dbCache[channel] = self._openDb(self.makeFilename(channel), ircutils.toLower(channel))
+        return db
+
+    def makeFilename(self, channel):
+        """ With the single storage every channel is in the same file"""
+
+        if self.storage == 'single':
+            return conf.supybot.directories.data.dirize(self.__class__.__name__ + self.suffix)
+        return plugins.ChannelDBHandler.makeFilename(self, channel)
+
+    def _openDb(self, filename, channel=None):
+        """ Returns the connection to db file 'filename', opening it and restoring its announcing polls
+        the first time. 'channel' is the lowercase channel of a per channel file"""
+
+        db = self.db_files.get(filename)
+        if db is None:
+            if self.storage == 'single':
+                channel = None
+            db = self.db_files[filename] = self.makeDb(filename, channel)
+            db.isolation_level = None
+            self.unrestored.pop(filename, None)
+            self._keyVotes(db)
+            self._restoreDb(db)
+        return db
+
+    def _existingDbs(self):
+        """ Returns {filename: channel} of the db files there are for the storage in use, without opening them"""
 
-    def makeDb(self, filename):
-        """ If db file exists, do connection and return it, else make new db and return connection to it"""
+        if self.storage == 'single':
+            filename = self.makeFilename(None)
+            return {filename: None} if os.path.exists(filename) else {}
 
-        if os.path.exists(filename):
-            db = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-            db.text_factory = str
-            return db
-        db = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        dbs = {}
+        datadir = conf.supybot.directories.data()
+        filename = self.__class__.__name__ + self.suffix
+        for name in os.listdir(datadir):
+            path = os.path.join(datadir, name, filename)
+            if os.path.exists(path):
+                dbs[path] = ircutils.toLower(name)
+        return dbs
+
+    def _restoreDb(self, db):
+        """ Adds the announcing polls in 'db' to the announcer and the open polls with a deadline
+        to the deadlines, with one indexed query each"""
+
+        cursor = db.cursor()
+        self._execute_query(cursor, 'SELECT channel,id,announce_interval,next_announce FROM polls WHERE isAnnouncing=1 AND closed IS NULL')
+        for channel, pollid, interval, due in cursor.fetchall():
+            if self.announcer.entry(channel, pollid) is None:
+                # polls from before the schedule was saved get the default of 10 minutes
+                self.announcer.add(self.restore_irc, channel, pollid, interval or 600, due=due or time.time())
+
+        # deadlines that passed while the bot was away close the poll right away
+        self._execute_query(cursor, 'SELECT channel,id,deadline FROM polls WHERE deadline IS NOT NULL AND closed IS NULL')
+        now = time.time()
+        for channel, pollid, deadline in cursor.fetchall():
+            if deadline <= now:
+                self._expirePoll(self.restore_irc, channel, pollid)
+            elif self.deadlines.deadline(channel, pollid) is None:
+                self.deadlines.add(self.restore_irc, channel, pollid, deadline)
+
+    def _restoreSchedules(self):
+        """Run by supybot schedule, restores the announcing polls of a few db files each run until all are done"""
+
+        remove_event(self.restore_event) # we may be run by the event
+        self.restore_event = None
+        for filename, channel in list(self.unrestored.items())[:10]:
+            try:
+                self._openDb(filename, channel)
+            except Exception as e:
+                self.log.error('Failed to restore the polls in %s: %s' % (filename, e))
+                self.unrestored.pop(filename, None)
+        if self.unrestored:
+            self.restore_event = schedule.addEvent(self.db_executor.job(self._restoreSchedules), time.time() + 1, name='Polls_restore')
+
+    def makeDb(self, filename, channel=None):
+        """ Connects to db file, making it if it doesnt exist, upgrades its schema to the latest version and returns the connection.
+        'channel' is the lowercase channel of a per channel file, None for the single storage"""
+
+        db = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, check_same_thread=False)
         db.text_factory = str
+        self._configureDb(db)
+        try:
+            start = schema.migrate(db, channel)
+        except Exception as e:
+            self.log.error('Error upgrading %s to schema version %s: %s' % (filename, schema.VERSION, e))
+            db.close()
+            raise
+        if start != schema.VERSION:
+            self.log.info('Upgraded %s from schema version %s to %s' % (filename, start, schema.VERSION))
+        return db
+
+    def _configureDb(self, db):
+        """ Applies the pragmas from the supybot.plugins.Polls.sqlite config to a new connection"""
+
         cursor = db.cursor()
+        self._execute_query(cursor, 'PRAGMA busy_timeout = %d' % self.registryValue('sqlite.busyTimeout'))
+        # before the journal mode, which writes the header of a new db. only
+        # takes on a new db, older ones are switched over by _vacuum
+        self._execute_query(cursor, 'PRAGMA auto_vacuum = INCREMENTAL')
+        self._execute_query(cursor, 'PRAGMA journal_mode = %s' % self.registryValue('sqlite.journalMode'))
+        self._execute_query(cursor, 'PRAGMA synchronous = %s' % self.registryValue('sqlite.synchronous'))
+        self._execute_query(cursor, 'PRAGMA cache_size = -%d' % self.registryValue('sqlite.cacheSize'))
+        self._execute_query(cursor, 'PRAGMA mmap_size = %d' % self.registryValue('sqlite.mmapSize'))
+
+    def _maintainDbs(self):
+        """Run by supybot schedule, checkpoints the write-ahead log and lets sqlite
+        refresh its statistics on every open db"""
+
+        for filename, db in list(self.db_files.items()):
+            cursor = db.cursor()
+            try:
+                if self.registryValue('sqlite.journalMode') == 'wal':
+                    self._execute_query(cursor, 'PRAGMA wal_checkpoint(PASSIVE)')
+                self._execute_query(cursor, 'PRAGMA optimize')
+            except Exception as e:
+                self.log.warning('Maintenance of %s failed: %s' % (filename, e))
+
+    def _nextArchive(self):
+        """ Returns the time.time() of the next retention.hour"""
+
+        now = datetime.datetime.now()
+        run = now.replace(hour=self.registryValue('retention.hour'), minute=0, second=0, microsecond=0)
+        if run <= now:
+            run += datetime.timedelta(days=1)
+        return time.mktime(run.timetuple())
+
+    def _archivePolls(self):
+        """ Run by supybot schedule, archives the polls closed longer than the retention.graceDays of
+        their channel, at most retention.batch of them each run. When there are more it runs again
+        in a minute, else at the next retention.hour"""
+
+        remove_event(self.archive_event) # we may be run by the event
+        self.archive_event = None
+
+        # votes cast before closing still count
+        if self.vote_buffer:
+            self._flushVotes()
+
+        now = datetime.datetime.now()
+        budget = self.registryValue('retention.batch')
+        for filename, channel in sorted(self._existingDbs().items()):
+            # a per channel file that keeps its closed polls is not opened at all
+            if channel is not None and not self.registryValue('retention.graceDays', channel):
+                continue
+            # files not open yet are opened for the sweep only, they get restored on their turn
+            db = self.db_files.get(filename)
+            opened = db is None
+            if opened:
+                db = self.makeDb(filename, channel)
+                db.isolation_level = None
+            try:
+                cursor = db.cursor()
+                self._execute_query(cursor, 'SELECT channel,id,closed FROM polls WHERE closed IS NOT NULL AND archived IS NULL ORDER BY closed')
+                due = []
+                for pollchannel, pollid, closed in cursor.fetchall():
+                    grace = self.registryValue('retention.graceDays', pollchannel)
+                    if grace and closed <= now - datetime.timedelta(days=grace):
+                        due.append((pollchannel, pollid))
+                if not due:
+                    continue
+                try:
+                    self._archive(db, filename, due[:budget])
+                    self._vacuum(db, filename)
+                except Exception as e:
+                    self.log.error('Archiving the polls in %s failed: %s' % (filename, e))
+            finally:
+                if opened:
+                    db.close()
+            budget -= len(due[:budget])
+            if not budget:
+                break
+
+        next_run = time.time() + 60 if not budget else self._nextArchive()
+        self.archive_event = schedule.addEvent(self.db_executor.job(self._archivePolls), next_run, name='Polls_archive')
+
+    def _archive(self, db, filename, polls):
+        """ Rolls up the (channel, pollid) 'polls' of 'db', one transaction each: the final tally goes
+        in poll_summary, the votes are copied to the archive db next to 'filename' or just deleted
+        as the retention.votes of the channel says """
 
-        self._execute_query(cursor, """CREATE TABLE polls(
-                    id INTEGER PRIMARY KEY,
-                    started_time TIMESTAMP,         -- time when poll was created
-                    isAnnouncing INTEGER default 1, -- if poll is announcing to channel
-                    closed TIMESTAMP,               -- NULL by default, set to time when closed(no more voting allowed)
-                    question TEXT)""")
-        self._execute_query(cursor, """CREATE TABLE choices(
-                    poll_id INTEGER,
-                    choice_char TEXT,
-                    choice TEXT)""")
-        self._execute_query(cursor, """CREATE TABLE votes(
-                    id INTEGER PRIMARY KEY,
-                    poll_id INTEGER,
-                    voter_nick TEXT,
-                    voter_host TEXT,
-                    choice INTEGER,
-                    time timestamp)""")
-        db.commit()
-        return db
+        cursor = db.cursor()
+        archive = filename[:-len(self.suffix)] + '-archive' + self.suffix
+        # an attached db cant be changed in the middle of a transaction, so it is done beforehand.
+        # with wal the commit is atomic in each file but not across them, a failure in between
+        # leaves the votes in both and the poll to be archived again
+        self._execute_query(cursor, 'ATTACH DATABASE ? AS archive', archive)
+        try:
+            self._execute_query(cursor, """CREATE TABLE IF NOT EXISTS archive.votes(
+                                              channel TEXT, poll_id INTEGER, voter_nick TEXT,
+                                              voter_host TEXT, choice TEXT, time TIMESTAMP)""")
+            for channel, pollid in polls:
+                self._execute_query(cursor, 'BEGIN')
+                try:
+                    self._execute_query(cursor, """INSERT INTO poll_summary (channel,poll_id,choice_char,choice,votes)
+                                                  SELECT channel,poll_id,choice_char,choice,votes FROM choices
+                                                  WHERE channel=? AND poll_id=?""", channel, pollid)
+                    if self.registryValue('retention.votes', channel) == 'archive':
+                        self._execute_query(cursor, """INSERT INTO archive.votes (channel,poll_id,voter_nick,voter_host,choice,time)
+                                                      SELECT channel,poll_id,voter_nick,voter_host,choice,time FROM votes
+                                                      WHERE channel=? AND poll_id=?""", channel, pollid)
+                    # the choices go first, so the vote counter triggers have nothing to update
+                    self._execute_query(cursor, 'DELETE FROM choices WHERE channel=? AND poll_id=?', channel, pollid)
+                    self._execute_query(cursor, 'DELETE FROM votes WHERE channel=? AND poll_id=?', channel, pollid)
+                    self._execute_query(cursor, 'UPDATE polls SET archived=? WHERE channel=? AND id=?', datetime.datetime.now(), channel, pollid)
+                    self._execute_query(cursor, 'COMMIT')
+                except Exception:
+                    db.rollback()
+                    raise
+                self.poll_cache.invalidate(channel, pollid)
+                self.live.forget(channel, pollid)
+        finally:
+            self._execute_query(cursor, 'DETACH DATABASE archive')
+
+    def _vacuum(self, db, filename):
+        """ Gives the pages freed by archiving back to the filesystem. A db made before auto_vacuum
+        was set gets one full VACUUM to switch it to incremental """
+
+        cursor = db.cursor()
+        self._execute_query(cursor, 'PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            self.log.info('Switching %s to incremental vacuum' % filename)
+            self._execute_query(cursor, 'PRAGMA auto_vacuum = INCREMENTAL')
+            self._execute_query(cursor, 'VACUUM')
+        else:
+            # every step frees a page, so it is run to the end
+            self._execute_query(cursor, 'PRAGMA incremental_vacuum').fetchall()
 
     def _execute_query(self, cursor, queryString, *sqlargs):
         """ Executes a SqLite query
             in the given Db """
 
+        if self.stats is not None:
+            return self._execute_timed(cursor, cursor.execute, queryString, sqlargs)
         try:
             if sqlargs:
                 cursor.execute(queryString, sqlargs)
@@ -82,53 +408,192 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
 
         return cursor
 
-    def _poll_info(self, db, pollid):
-        """ Does SQL query with 'db' for 'pollid' and returns isAnnouncing, closed, question
-        or None if pollid doesnt exist
+    def _execute_many(self, cursor, queryString, rows):
+        """ Executes a SqLite query once for each of 'rows' """
 
-        ::isAnnouncing:: Integer 1 or 0
-        ::closed:: None or datetime object
-        ::question:: string""" 
+        if self.stats is not None:
+            return self._execute_timed(cursor, cursor.executemany, queryString, rows)
+        try:
+            cursor.executemany(queryString, rows)
+        except Exception as e:
+            self.log.error('Error with sqlite executemany: %s' % e)
+            self.log.error('For QueryString: %s' % queryString)
+            raise
+
+        return cursor
+
+    def _execute_timed(self, cursor, execute, queryString, sqlargs):
+        """ _execute_query and _execute_many when stats are on. The rows the query returns are
+        counted as they are fetched, a write that isnt in a transaction is counted as a commit """
+
+        start = time.perf_counter()
+        try:
+            execute(queryString, sqlargs)
+        except Exception as e:
+            self.log.error('Error with sqlite execute: %s' % e)
+            self.log.error('For QueryString: %s' % queryString)
+            raise
+        finally:
+            key = self.stats.statement(queryString, time.perf_counter() - start)
+
+        def count(cursor, row):
+            self.stats.row(key)
+            return row
+        cursor.row_factory = count
+        if not cursor.connection.in_transaction and queryString.split(None, 1)[0].upper() not in ('SELECT', 'PRAGMA', 'BEGIN'):
+            self.stats.commits += 1
+        return cursor
+
+    # matches the vote of a voter on a poll through the votes_voter unique index,
+    # takes the channel, the poll id and the key from _voterKey
+    VOTER_WHERE = 'channel=? AND poll_id=? AND voter_key=?'
+
+    # inserts a vote, or changes the vote the voter already has on the poll. a vote for the
+    # same choice is left as it is. previous_choice is the choice a change replaced
+    VOTE_UPSERT = """INSERT INTO votes (channel,poll_id,voter_key,voter_nick,voter_host,choice,time) VALUES (?,?,?,?,?,?,?)
+                     ON CONFLICT (channel,poll_id,voter_key) DO UPDATE SET previous_choice=choice, choice=excluded.choice,
+                         voter_nick=excluded.voter_nick, voter_host=excluded.voter_host, time=excluded.time
+                     WHERE choice != excluded.choice"""
+
+    # UPSERT .. RETURNING reads back the choice a vote replaced in the same statement,
+    # older sqlite gets it with a SELECT first
+    RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+
+    def _voterKey(self, cursor, channel, pollid, msg):
+        """ Returns the voter_key of the sender of 'msg' for the voterIdentity of 'channel'. With the
+        account identity their vote on 'pollid' from before there were keys becomes theirs, see
+        voterkey.legacy_key """
+
+        strategy = self.registryValue('voterIdentity', channel)
+        key = voterkey.key(strategy, msg)
+        if strategy == 'account':
+            self._execute_query(cursor, 'UPDATE OR IGNORE votes SET voter_key=? WHERE ' + self.VOTER_WHERE,
+                                key, channel, pollid, voterkey.legacy_key(strategy, msg.nick, msg.host))
+        return key
+
+    def _keyVotes(self, db):
+        """ Gives the votes without a voter_key, cast before there were keys or imported from a
+        db that had them, the key of the voterIdentity of their channel. Of the votes of a poll
+        that get the same key the latest stays """
 
         cursor = db.cursor()
-        self._execute_query(cursor, 'SELECT isAnnouncing,closed,question FROM polls WHERE id=?', pollid)
-        result = cursor.fetchone()
-        if result is None:
+        self._execute_query(cursor, 'SELECT id,channel,voter_nick,voter_host FROM votes WHERE voter_key IS NULL ORDER BY id DESC')
+        rows = cursor.fetchall()
+        if not rows:
             return
+        self._execute_query(cursor, 'BEGIN')
+        try:
+            for rowid, channel, nick, host in rows:
+                key = voterkey.legacy_key(self.registryValue('voterIdentity', channel), nick or '', host or '')
+                self._execute_query(cursor, 'UPDATE OR IGNORE votes SET voter_key=? WHERE id=?', key, rowid)
+                if not cursor.rowcount:
+                    self._execute_query(cursor, 'DELETE FROM votes WHERE id=?', rowid)
+            self._execute_query(cursor, 'COMMIT')
+        except Exception:
+            db.rollback()
+            raise
 
-        return result[0], result[1], result[2]
+    def _poll_info(self, channel, pollid):
+        """ Returns isAnnouncing, closed, question, archived, kind, deadline for 'pollid' in 'channel' from the poll cache,
+        doing SQL query on a miss, or None if pollid doesnt exist
 
-    def _runPoll(self, irc, channel, pollid):
-        """Run by supybot schedule, outputs poll question and choices into channel at set interval"""
+        ::isAnnouncing:: Integer 1 or 0
+        ::closed:: None or datetime object
+        ::question:: string
+        ::archived:: None or datetime object, when the votes were rolled up into poll_summary
+        ::kind:: 'single', 'approval' or 'ranked'
+        ::deadline:: None or the time.time() the poll closes by itself""" 
+
+        def load():
+            cursor = self.getDb(channel).cursor()
+            self._execute_query(cursor, 'SELECT isAnnouncing,closed,question,archived,kind,deadline FROM polls WHERE channel=? AND id=?', channel, pollid)
+            result = cursor.fetchone()
+            if result is None:
+                return
 
-        db = self.getDb(channel)
-        cursor = db.cursor()
+            return result[0], result[1], result[2], result[3], result[4], result[5]
 
-        pollinfo = self._poll_info(db, pollid)
-        if pollinfo is None:
-            schedule.removeEvent('%s_poll_%s' % (channel, pollid))
-            raise Exception('_runPoll couldnt get pollinfo')
-        else:
-            is_announcing, closed, question = pollinfo
+        return self.poll_cache.get(channel, 'info', pollid, load)
 
-        # if poll shouldnt be announcing or is closed, then stop schedule
-        if (not is_announcing) or closed:
-            try:
-                schedule.removeEvent('%s_poll_%s' % (channel, pollid))
-                self.poll_schedules.remove('%s_poll_%s' % (channel, pollid))
-            except:
-                self.log.warning('_runPoll Failed to remove schedule event for %s %s' % (channel, pollid))
-            return
+    def _choices(self, channel, pollid):
+        """ Returns a tally.Tally without vote counts for 'pollid' in 'channel' from the poll cache,
+        doing SQL query on a miss, or None if pollid doesnt exist. The Tally is shared, dont change it"""
+
+        def load():
+            return self._tally(channel, pollid, counts=False) or None
+
+        return self.poll_cache.get(channel, 'choices', pollid, load)
+
+    def _tally(self, channel, pollid, counts=True):
+        """ Does a single SQL query for the choices of 'pollid' in 'channel' and their vote counts, returns a tally.Tally.
+        If 'counts' is False only the choices are fetched and the vote counts are None.
+        The Tally has no choices if pollid doesnt exist"""
 
-        irc.reply('Poll #%s: %s' % (pollid, question), prefixNick=False, to=channel)
+        return tally.tally(self.getDb(channel).cursor(), channel, pollid, counts, execute=self._execute_query)
 
-        self._execute_query(cursor, 'SELECT choice_char,choice FROM choices WHERE poll_id=? ORDER BY choice_char', pollid)
+    def _outcome(self, channel, pollid, closed=None):
+        """ Returns the tabulate.Outcome of the ranked poll 'pollid' in 'channel'. The outcome of a poll
+        that is 'closed' is the one saved by closepoll, from the poll cache. Else the ballots are read
+        with one query and counted"""
 
-        # output all of the polls choices
-        choice_row = cursor.fetchone()
-        while choice_row is not None:
-            irc.reply('%s: %s' % (choice_row[0], choice_row[1]), prefixNick=False, to=channel)
-            choice_row = cursor.fetchone()
+        from . import tabulate
+
+        def load():
+            cursor = self.getDb(channel).cursor()
+            self._execute_query(cursor, 'SELECT outcome FROM polls WHERE channel=? AND id=?', channel, pollid)
+            result = cursor.fetchone()
+            if result is None or result[0] is None:
+                return
+            return tabulate.Outcome.from_json(result[0])
+
+        if closed is not None:
+            outcome = self.poll_cache.get(channel, 'outcome', pollid, load)
+            if outcome is not None:
+                return outcome
+
+        cursor = self.getDb(channel).cursor()
+        self._execute_query(cursor, tabulate.BALLOTS_QUERY, channel, pollid)
+        return tabulate.irv(self._choices(channel, pollid), (row[0] for row in cursor))
+
+    def _result_lines(self, channel, pollid, pollinfo, load):
+        """ The results of a poll with the _poll_info 'pollinfo' as a list of text. load() returns the
+        tally.Tally of a single or approval poll, ranked polls are counted by _outcome"""
+
+        if pollinfo[4] == 'ranked':
+            return self._outcome(channel, pollid, pollinfo[1]).result_lines()
+        return load().result_lines()
+
+    def _announce(self, irc, channel, pollids):
+        """Run by the announcer, returns the lines announcing the polls 'pollids' in 'channel'.
+        Polls that are closed or shouldnt be announcing are dropped from the announcer"""
+
+        maxlen = self._lineLength(irc, channel)
+        lines = []
+        announced = []
+        kinds = set()
+        for pollid in pollids:
+            pollinfo = self._poll_info(channel, pollid)
+            # if poll is gone, shouldnt be announcing or is closed, then stop announcing it
+            if pollinfo is None or not pollinfo[0] or pollinfo[1]:
+                self.announcer.remove(channel, pollid)
+                continue
+            # question and choices packed in as few lines as fit
+            kind = pollinfo[4]
+            if kind == 'single':
+                items = ['Poll #%s: %s' % (pollid, pollinfo[2])]
+            else:
+                items = ['Poll #%s (%s): %s' % (pollid, kind, pollinfo[2])]
+            items += self._choices(channel, pollid).choice_lines()
+            lines.extend(self._packLines(items, maxlen))
+            announced.append(pollid)
+            kinds.add(kind)
+
+        if not announced:
+            return lines
+
+        # save when each poll is due next, so the schedule survives a restart
+        self._execute_many(self.getDb(channel).cursor(), 'UPDATE polls SET next_announce=? WHERE channel=? AND id=?',
+                           [(self.announcer.entry(channel, pollid).due, channel, pollid) for pollid in announced])
 
         prefixChars = conf.supybot.reply.whenAddressedBy.chars()
         prefixStrings = conf.supybot.reply.whenAddressedBy.strings()
@@ -140,100 +605,284 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
         else:
             vote_cmd = ': '.join((irc.nick,'vote'))
 
-        irc.reply('To vote, do %s %s <choice number>' % (vote_cmd, pollid), prefixNick=False, to=channel) 
+        if len(kinds) == 1:
+            ballot = self.BALLOT_HINTS[kinds.pop()]
+        else:
+            ballot = '<choice letter(s)>'
+        if len(announced) == 1:
+            lines.append('To vote, do %s %s %s' % (vote_cmd, announced[0], ballot))
+        else:
+            lines.append('To vote, do %s <poll id> %s' % (vote_cmd, ballot))
+        if self.stats is not None:
+            self.stats.reply('_announce', len(lines))
+        return lines
 
-    def newpoll(self, irc, msg, args, channel, interval, answers, question):
-        """<number of minutes for announce interval> <"answer,answer,..."> question
-        Creates a new poll with the given question and answers. <channel> is
-        only necessary if the message isn't sent in the channel itself."""
+    _announce = timed(_announce)
+
+    # what goes after the poll id in the vote line of the announcements, by kind of poll
+    BALLOT_HINTS = {'single': '<choice letter>',
+                    'approval': '<every choice letter you approve of>',
+                    'ranked': '<choice letters, most preferred first>'}
+
+    def _lineLength(self, irc, target):
+        """Number of bytes of text that fit in one message to 'target', leaving
+        room for the longest prefix the server can put in front of it"""
+
+        return 512 - len(':%s!%s@%s PRIVMSG %s :\r\n' % (irc.nick, 'x' * 10, 'x' * 63, target))
+
+    def _packLines(self, items, maxlen, separator=' | '):
+        """Joins 'items' with 'separator' into lines of at most 'maxlen' bytes.
+        An item too long for a line gets a line of its own"""
+
+        lines = []
+        line = None
+        for item in items:
+            if line is not None and len((line + separator + item).encode('utf-8')) <= maxlen:
+                line += separator + item
+            else:
+                if line is not None:
+                    lines.append(line)
+                line = item
+        if line is not None:
+            lines.append(line)
+        return lines
+
+    def newpoll(self, irc, msg, args, channel, optlist, interval, answers, question):
+        """[<channel>] [--approval|--ranked] [--closes <duration|date>] <number of minutes for announce interval> <"answer,answer,..."> question
+        Creates a new poll with the given question and answers. People vote
+        for one answer, or with --approval for every answer they approve of,
+        or with --ranked for answers in order of preference, counted by instant
+        runoff. With --closes the poll closes by itself after a duration like
+        90m, 2h or 1d12h, or at a date like 2026-05-01T18:00, and its results
+        are announced. <channel> is only necessary if the message isn't sent
+        in the channel itself."""
 
         capability = ircdb.makeChannelCapability(channel, 'op')
         if not ircdb.checkCapability(msg.prefix, capability):
             irc.error('Need ops')
             return
 
+        channel = ircutils.toLower(channel) # channels are stored lowercase
+        kind = 'single'
+        deadline = None
+        for (option, value) in optlist:
+            if option == 'closes':
+                deadline = self._deadline(irc, value)
+                if deadline is None:
+                    return
+            else:
+                kind = option
         db = self.getDb(channel)
         cursor = db.cursor()
-        self._execute_query(cursor, 'INSERT INTO polls VALUES (?,?,?,?,?)', None, datetime.datetime.now(), 1, None, question)
-        pollid = cursor.lastrowid
 
-        # used to add choices into db. each choice represented by character, starting at capital A (code 65)
-        def genAnswers():
-            for i, answer in enumerate(answers, start=65):
-                yield pollid, chr(i), answer
+        # poll ids count up in each channel, even when channels share a db
+        self._execute_query(cursor, 'BEGIN IMMEDIATE')
+        try:
+            self._execute_query(cursor, 'SELECT coalesce(max(id), 0) + 1 FROM polls WHERE channel=?', channel)
+            pollid = cursor.fetchone()[0]
+            self._execute_query(cursor, 'INSERT INTO polls (channel,id,started_time,isAnnouncing,closed,question,announce_interval,next_announce,kind,deadline) VALUES (?,?,?,?,?,?,?,?,?,?)',
+                                channel, pollid, datetime.datetime.now(), 1, None, question, interval*60, time.time(), kind, deadline)
 
-        cursor.executemany('INSERT INTO choices VALUES (?,?,?)', genAnswers())
+            # used to add choices into db. each choice represented by character, starting at capital A (code 65)
+            def genAnswers():
+                for i, answer in enumerate(answers, start=65):
+                    yield channel, pollid, chr(i), answer
 
-        db.commit()
+            self._execute_many(cursor, 'INSERT INTO choices (channel,poll_id,choice_char,choice) VALUES (?,?,?,?)', genAnswers())
 
-        irc.reply('Started new poll #%s' % pollid)
+            self._execute_query(cursor, 'COMMIT')
+        except Exception:
+            db.rollback()
+            raise
+        self.poll_cache.invalidate(channel, pollid)
 
-        # function called by schedule event. can not have args
-        def runPoll():
-            self._runPoll(irc, channel, pollid)
+        if deadline is None:
+            irc.reply('Started new poll #%s' % pollid)
+        else:
+            irc.reply('Started new poll #%s, it closes on %s' % (pollid, time.strftime('%Y-%m-%d at %-I:%M %p', time.localtime(deadline))))
+            self.deadlines.add(irc.getRealIrc(), channel, pollid, deadline)
 
-        # start schedule. will announce poll/choices to channel at interval
-        schedule.addPeriodicEvent(runPoll, interval*60, name='%s_poll_%s' % (channel, pollid))
-        self.poll_schedules.append('%s_poll_%s' % (channel, pollid))
+        # will announce poll/choices to channel now and at interval
+        self.announcer.add(irc.getRealIrc(), channel, pollid, interval*60)
 
-    newpoll = wrap(newpoll, ['channeldb', 'Op', 'positiveInt', commalist('something'), 'text'])
+    newpoll = wrap(dbthread(newpoll), ['channeldb', 'Op', getopts({'approval': '', 'ranked': '', 'closes': 'something'}),
+                                       'positiveInt', commalist('something'), 'text'])
 
-    def vote(self, irc, msg, args, channel, pollid, choice):
-        """[<channel>] <poll id number> <choice letter>
+    def _deadline(self, irc, text):
+        """ Returns the time.time() the --closes 'text' stands for, or None after replying with the error"""
+
+        try:
+            deadline = deadlines.parse(text)
+        except ValueError:
+            irc.errorInvalid('duration or date', text)
+            return None
+        if deadline <= time.time():
+            irc.error('%s has already passed' % text)
+            return None
+        return deadline
+
+    def vote(self, irc, msg, args, channel, pollid, letters):
+        """[<channel>] <poll id number> <choice letter> [<choice letter> ...]
         Vote for the option with the given <choice letter> on the poll with
-        the given poll <id>. This command can also be used to override any
-        previous vote. <channel> is only necesssary if the message isn't sent
-        in the channel itself."""
+        the given poll <id>. On approval polls give every option you approve
+        of, on ranked polls the options in order of preference, most preferred
+        first. This command can also be used to override any previous vote.
+        <channel> is only necesssary if the message isn't sent in the channel
+        itself."""
 
-        choice = choice.upper()
+        letters = [letter.upper() for letter in letters]
+        channel = ircutils.toLower(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
 
         # query to check that poll exists and it isnt closed
-        pollinfo = self._poll_info(db, pollid)
+        pollinfo = self._poll_info(channel, pollid)
         if pollinfo is None:
             irc.error('No poll with that id')
             return
         if pollinfo[1] is not None:
             irc.error('This poll was closed on %s' % pollinfo[1].strftime('%Y-%m-%d at %-I:%M %p'))
             return
+        if pollinfo[5] is not None and pollinfo[5] <= time.time():
+            # its deadline passed before the tick got to it
+            self._expirePoll(irc.getRealIrc(), channel, pollid)
+            irc.error('This poll closed on %s' % time.strftime('%Y-%m-%d at %-I:%M %p', time.localtime(pollinfo[5])))
+            return
 
-        # query to check that their choice exists
-        self._execute_query(cursor, 'SELECT * FROM choices WHERE poll_id=? AND choice_char=?', pollid, choice)
-        result = cursor.fetchone()
-        if result is None:
+        # check that their choices exist and fit the kind of poll
+        poll_choices = self._choices(channel, pollid)
+        if poll_choices is None or [letter for letter in letters if letter not in poll_choices]:
             irc.error('That is not a choice for that poll')
             return
-
-        # query to check they havnt already voted on this poll
-        self._execute_query(cursor, 'SELECT choice,time FROM votes WHERE (voter_nick=? OR voter_host=?) AND poll_id=?', msg.nick, msg.host, pollid)
-        result = cursor.fetchone()
-        if result is not None:
-            if result[0] == choice:
-                irc.error('You have already voted for %s on %s' % (result[0], result[1].strftime('%Y-%m-%d at %-I:%M %p')))
-                return
-            else:
-                # query to update their vote
-                self._execute_query(cursor, 'UPDATE votes SET choice=?, time=? WHERE (voter_nick=? OR voter_host=?) AND poll_id=?', choice, datetime.datetime.now(), msg.nick, msg.host, pollid)
+        kind = pollinfo[4]
+        if kind == 'single' and len(letters) > 1:
+            irc.error('This poll takes one choice')
+            return
+        if len(set(letters)) != len(letters):
+            irc.error('Give each choice only once')
+            return
+        # the ballot is kept as the string of its letters, in order of preference for ranked polls
+        if kind == 'approval':
+            letters.sort()
+        choice = ''.join(letters)
+
+        # the buffer and live results count one choice per vote
+        key = self._voterKey(cursor, channel, pollid, msg)
+        if self.registryValue('buffer.enable') and kind == 'single':
+            self._bufferVote(db, channel, pollid, msg, key, choice, irc)
+            return
+        elif self.vote_buffer.votes(channel, pollid):
+            # buffering was turned off, the votes of the poll go in before this one, the
+            # others are left to the flush event
+            self._flushVotes(poll=(channel, pollid))
+
+        # query to insert or change their vote, it returns no row if they already voted for that
+        if self.RETURNING:
+            self._execute_query(cursor, self.VOTE_UPSERT + ' RETURNING previous_choice',
+                                channel, pollid, key, msg.nick, msg.host, choice, datetime.datetime.now())
+            result = cursor.fetchall()
         else:
-            # query to insert their vote
-            self._execute_query(cursor, 'INSERT INTO votes VALUES (?,?,?,?,?,?)', None, pollid, msg.nick, msg.host, choice, datetime.datetime.now())
+            self._execute_query(cursor, 'SELECT choice FROM votes WHERE ' + self.VOTER_WHERE, channel, pollid, key)
+            result = cursor.fetchall() or [(None,)]
+            if result[0][0] == choice:
+                result = []
+            else:
+                self._execute_query(cursor, self.VOTE_UPSERT, channel, pollid, key, msg.nick, msg.host, choice, datetime.datetime.now())
         db.commit()
+        if not result:
+            self._execute_query(cursor, 'SELECT time FROM votes WHERE ' + self.VOTER_WHERE, channel, pollid, key)
+            irc.error('You have already voted for %s on %s' % (' '.join(choice), cursor.fetchone()[0].strftime('%Y-%m-%d at %-I:%M %p')))
+            return
+        old = result[0][0]
 
-        irc.reply('Your vote on poll #%s for %s has been inputed, sending you results in PM' % (pollid, choice), prefixNick=False)
-        irc.reply('Here is results for poll #%s, you just voted for %s' % (pollid, choice), prefixNick=False, private=True)
+        self._voteReply(irc, channel, pollid, old, choice, lambda: self._tally(channel, pollid), pollinfo)
 
-        # query loop thru each choice for this poll, and for each choice another query to grab number of votes, and output
-        cursor2 = db.cursor()
-        self._execute_query(cursor, 'SELECT choice_char,choice FROM choices WHERE poll_id=? ORDER BY choice_char', pollid)
-        choice_row = cursor.fetchone()
-        while choice_row is not None:
-            self._execute_query(cursor2, 'SELECT count(*) FROM votes WHERE poll_id=? AND choice=?', pollid, choice_row[0])
-            vote_row = cursor2.fetchone()
-            irc.reply('%s: %s - %s votes' % (choice_row[0], choice_row[1], vote_row[0]), prefixNick=False, private=True)
-            choice_row = cursor.fetchone()
+    def _bufferVote(self, db, channel, pollid, msg, key, choice, irc):
+        """vote for when buffering is on. Checks for a previous vote in the buffer then the db,
+        buffers the vote and replies with the tally plus the pending votes"""
+
+        pending = self.vote_buffer.find(channel, pollid, key)
+        if pending is not None:
+            if pending.choice == choice:
+                irc.error('You have already voted for %s on %s' % (pending.choice, pending.time.strftime('%Y-%m-%d at %-I:%M %p')))
+                return
+            # the pending vote keeps what it replaces in the db, so just change it
+            old = pending.choice
+            pending.choice = choice
+            pending.time = datetime.datetime.now()
+        else:
+            # query to check they havnt already voted on this poll
+            cursor = db.cursor()
+            self._execute_query(cursor, 'SELECT choice,time FROM votes WHERE ' + self.VOTER_WHERE, channel, pollid, key)
+            result = cursor.fetchone()
+            if result is not None and result[0] == choice:
+                irc.error('You have already voted for %s on %s' % (result[0], result[1].strftime('%Y-%m-%d at %-I:%M %p')))
+                return
+            old = result and result[0]
+            self.vote_buffer.add(channel, votebuffer.PendingVote(pollid, key, msg.nick, msg.host, choice, datetime.datetime.now(), old))
+
+        if len(self.vote_buffer) >= self.registryValue('buffer.maxSize'):
+            self._flushVotes()
+        elif self.flush_event is None:
+            self.flush_event = schedule.addEvent(self.db_executor.job(self._flushVotes), time.time() + self.registryValue('buffer.maxAge'),
+                                                 name='Polls_flush_votes')
+
+        self._voteReply(irc, channel, pollid, old, choice, lambda: self.vote_buffer.adjust(channel, self._tally(channel, pollid)),
+                        self._poll_info(channel, pollid))
+
+    def _voteReply(self, irc, channel, pollid, old, choice, load, pollinfo):
+        """Tells the voter their vote, moved from choice 'old' (None for a new vote), went in.
+        load() returns the tally.Tally with their vote. With live results the running tally
+        of a single choice poll is updated and pushed later, else the voter is PMed the results"""
+
+        if self.registryValue('live.enable', channel) and pollinfo[4] == 'single':
+            self.live.vote(irc.getRealIrc(), channel, pollid, old, choice, load)
+            irc.reply('Your vote on poll #%s for %s has been inputed' % (pollid, choice), prefixNick=False)
+            return
+        elif self.live.polls:
+            # a running tally stops being right once it misses a vote
+            self.live.reset(channel, pollid)
 
-    vote = wrap(vote, ['channeldb', 'positiveInt', 'letter'])
+        result_lines = self._result_lines(channel, pollid, pollinfo, load)
+        choice = ' '.join(choice)
+        irc.reply('Your vote on poll #%s for %s has been inputed, sending you results in PM' % (pollid, choice), prefixNick=False)
+        # one reply, supybot splits it up to the line limit and keeps the rest for 'more'
+        irc.reply('Here is results for poll #%s, you just voted for %s: %s' % (pollid, choice, ' | '.join(result_lines)),
+                  prefixNick=False, private=True)
+
+    def _flushVotes(self, retry=True, poll=None):
+        """Writes the buffered votes to the channel dbs, one transaction per channel.
+        Run by supybot schedule, when the buffer is full and on die. With 'poll', a
+        (channel, pollid), only the votes of that poll are written. The votes of a
+        channel that fail to be written go back in the buffer, to be tried again
+        buffer.maxAge later unless 'retry' is False"""
+
+        if poll is None:
+            remove_event(self.flush_event) # we may be run by the event
+            self.flush_event = None
+
+        for channel, pending in self.vote_buffer.take(*(poll or ())):
+            rows = [(channel, v.pollid, v.key, v.nick, v.host, v.choice, v.time) for v in pending]
+            db = None
+            try:
+                db = self.getDb(channel)
+                cursor = db.cursor()
+                self._execute_query(cursor, 'BEGIN')
+                self._execute_many(cursor, self.VOTE_UPSERT, rows)
+                self._execute_query(cursor, 'COMMIT')
+            except Exception as e:
+                self.log.error('Failed to write %s buffered votes for %s: %s' % (len(pending), channel, e))
+                if db is not None and db.in_transaction:
+                    db.rollback()
+                # the voters were told their vote went in, so they are kept for the next flush
+                for vote in pending:
+                    self.vote_buffer.add(channel, vote)
+
+        if self.vote_buffer and retry and self.flush_event is None:
+            self.flush_event = schedule.addEvent(self.db_executor.job(self._flushVotes), time.time() + self.registryValue('buffer.maxAge'),
+                                                 name='Polls_flush_votes')
+
+    vote = wrap(throttled(dbthread(timed(vote))), ['channeldb', 'positiveInt', many('letter')])
 
     def results(self, irc, msg, args, channel, pollid):
         """[<channel>] <id>
@@ -241,59 +890,221 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
         <channel> is only necessary if the message is not sent in the
         channel itself. You have to had voted already"""
 
+        channel = ircutils.toLower(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
 
-        # query to make sure this poll exists. make new cursor since we will use it further below to output results
-        cursor1 = db.cursor()
-        self._execute_query(cursor1, 'SELECT choice_char,choice FROM choices WHERE poll_id=? ORDER BY choice_char', pollid)
-        choice_row = cursor1.fetchone()
-        if choice_row is None:
+        # query to make sure this poll exists, the tally is kept to output results further below
+        poll_tally = self._tally(channel, pollid)
+        if not poll_tally:
             irc.error('I dont think that poll id exists')
             return
 
-        # query to make sure they have already voted on this poll
-        self._execute_query(cursor, 'SELECT id FROM votes WHERE poll_id=? AND (voter_nick=? OR voter_host=?)', pollid, msg.nick, msg.host)
-        result = cursor.fetchone()
+        # query to make sure they have already voted on this poll, their vote might still be buffered.
+        # the votes of archived polls are gone, their results are for everyone
+        args = (channel, pollid, self._voterKey(cursor, channel, pollid, msg))
+        result = self.vote_buffer.find(*args)
         if result is None:
+            self._execute_query(cursor, 'SELECT id FROM votes WHERE ' + self.VOTER_WHERE, *args)
+            result = cursor.fetchone()
+        pollinfo = self._poll_info(channel, pollid)
+        if result is None and pollinfo[3] is None:
             irc.error('You need to vote first to view results!')
             return
 
-        irc.reply('Here is results for poll #%s' % pollid, prefixNick=False, private=True)
-
-        # query loop thru each choice for this poll, and for each choice another query to grab number of votes, and output
-        cursor2 = db.cursor()
-        while choice_row is not None: 
-            self._execute_query(cursor2, 'SELECT count(*) FROM votes WHERE poll_id=? AND choice=?', pollid, choice_row[0])
-            vote_row = cursor2.fetchone()
-            irc.reply('%s: %s - %s votes' % (choice_row[0], choice_row[1], vote_row[0]), prefixNick=False, private=True)
-            choice_row = cursor1.fetchone()
+        result_lines = self._result_lines(channel, pollid, pollinfo, lambda: self.vote_buffer.adjust(channel, poll_tally))
+        irc.reply('Here is results for poll #%s: %s' % (pollid, ' | '.join(result_lines)),
+                  prefixNick=False, private=True)
 
-    results = wrap(results, ['channeldb', 'positiveInt'])
+    results = wrap(throttled(dbthread(timed(results))), ['channeldb', 'positiveInt'])
 
-    #TODO finish this command...
     def openpolls(self, irc, msg, args, channel):
         """[<channel>]
         Privately lists the currently open polls for <channel>. <channel> is
         only necessary if the message isn't sent in the channel itself."""
+        channel = ircutils.toLower(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
 
-        self._execute_query(cursor, 'SELECT id,question FROM polls WHERE closed is NULL')
+        # one query for every open poll along with its choices
+        self._execute_query(cursor, """SELECT p.id,p.kind,p.question,c.choice_char,c.choice FROM polls p
+                                       JOIN choices c ON c.channel=p.channel AND c.poll_id=p.id
+                                       WHERE p.channel=? AND p.closed IS NULL ORDER BY p.id,c.choice_char""", channel)
+
+        polls = []
+        for pollid, kind, question, choice_char, choice in cursor:
+            if not polls or polls[-1][0] != pollid:
+                polls.append((pollid, kind, question, []))
+            polls[-1][3].append('%s: %s' % (choice_char, choice))
+
+        if not polls:
+            irc.reply('There are no open polls in %s' % channel, prefixNick=False, private=True)
+            return
+
+        # one reply, supybot splits it up to the line limit and keeps the rest for 'more'
+        irc.reply(' | '.join('Poll #%s%s: %s (%s)' % (pollid, '' if kind == 'single' else ' (%s)' % kind, question, ', '.join(choices))
+                             for pollid, kind, question, choices in polls),
+                  prefixNick=False, private=True)
+
+    openpolls = wrap(dbthread(timed(openpolls)), ['channeldb'])
+
+    def searchpolls(self, irc, msg, args, optlist, text):
+        """[--channel <channel>] [--open|--closed] [--since <YYYY-MM-DD>] [--until <YYYY-MM-DD>] [--page <n>] <keywords>
+        Lists the polls of every channel with all the <keywords> in their
+        question or choices, most recent first. A keyword ending in * matches
+        the words starting with it. The polls can be narrowed to a channel, to
+        open or closed ones and to those started in a date range. Searching
+        every channel needs the admin capability, searching one needs op in it."""
+
+        from . import search
+
+        channel = status = since = until = None
+        page = 1
+        for (option, value) in optlist:
+            if option == 'channel':
+                channel = ircutils.toLower(value)
+            elif option in search.STATUSES:
+                status = option
+            elif option == 'page':
+                page = value
+            else:
+                try:
+                    date = search.parse_date(value)
+                except ValueError:
+                    irc.errorInvalid('date', value)
+                    return
+                if option == 'since':
+                    since = date
+                else:
+                    until = date
+
+        capability = 'admin' if channel is None else ircdb.makeChannelCapability(channel, 'op')
+        if not ircdb.checkCapability(msg.prefix, capability):
+            irc.errorNoCapability(capability)
+            return
+        match = search.match_query(text)
+        if match is None:
+            irc.error('Give me something to search for')
+            return
+
+        # one query for the count and one for the page in each db. per channel dbs are
+        # each searched for the polls up to the page, the page is taken from all of them.
+        # only the files there are get opened, naming a channel without polls makes none
+        dbs = [self._openDb(filename, dbchannel) for filename, dbchannel in sorted(self._existingDbs().items())
+               if channel is None or dbchannel in (None, channel)]
+        if not all(schema.has_search(db) for db in dbs):
+            irc.error('Searching needs the FTS5 module of sqlite, which this bot\'s sqlite lacks')
+            return
+        size = self.registryValue('search.pageSize')
+        total = 0
+        results = []
+        for db in dbs:
+            cursor = db.cursor()
+            sql, sqlargs = search.query(match, channel, status, since, until, count=True)
+            self._execute_query(cursor, sql, *sqlargs)
+            found = cursor.fetchone()[0]
+            if not found:
+                continue
+            total += found
+            sql, sqlargs = search.query(match, channel, status, since, until)
+            if len(dbs) == 1:
+                self._execute_query(cursor, sql, *(sqlargs + [size, (page - 1) * size]))
+            else:
+                self._execute_query(cursor, sql, *(sqlargs + [page * size, 0]))
+            results.append(cursor.fetchall())
+
+        if not total:
+            irc.reply('No polls match that')
+            return
+        pages = (total + size - 1) // size
+        if page > pages:
+            irc.error('There are only %s pages' % pages)
+            return
+        if len(dbs) == 1:
+            rows = results[0]
+        else:
+            rows = search.merge(results, page * size)[(page - 1) * size:]
+
+        def describe(closed):
+            return 'open' if closed is None else 'closed %s' % closed.strftime('%Y-%m-%d')
+
+        irc.reply('%s polls, page %s of %s: %s' % (total, page, pages,
+                  ' | '.join('%s #%s: %s (%s)' % (pollchannel, pollid, question, describe(closed))
+                             for pollchannel, pollid, question, started_time, closed in rows)))
+
+    searchpolls = wrap(dbthread(timed(searchpolls)), [getopts({'channel': 'channel', 'open': '', 'closed': '',
+                                                                'since': 'something', 'until': 'something',
+                                                                'page': 'positiveInt'}),
+                                                       'text'])
+
+    def pollwatch(self, irc, msg, args, channel, pollid):
+        """[<channel>] <id>
+        Sends you the changes to the results of the poll with the given <id>
+        as votes come in, or stops them if you already get them. Only polls
+        of channels with live results turned on have them. <channel> is only
+        necessary if the message isn't sent in the channel itself."""
+
+        channel = ircutils.toLower(channel)
+        if not self.registryValue('live.enable', channel):
+            irc.error('Live results are not on in %s' % channel)
+            return
+        pollinfo = self._poll_info(channel, pollid)
+        if pollinfo is None:
+            irc.error('That poll id does not exist')
+            return
+        if pollinfo[1] is not None:
+            irc.error('That poll is closed')
+            return
+        if pollinfo[4] != 'single':
+            irc.error('Only single choice polls have live results')
+            return
+
+        if self.live.subscribe(channel, pollid, msg.nick):
+            irc.reply('You will get the live results of poll #%s' % pollid)
+        else:
+            irc.reply('You will no longer get the live results of poll #%s' % pollid)
+
+    pollwatch = wrap(dbthread(pollwatch), ['channeldb', 'positiveInt'])
+
+    def exportpoll(self, irc, msg, args, channel, pollid, format):
+        """[<channel>] <id> [csv|jsonl]
+        Writes the poll with the given <id>, its choices with their votes and
+        every vote to a CSV (the default) or JSON lines file in the data
+        directory of the bot. <channel> is only necessary if the message
+        isn't sent in the channel itself."""
+
+        channel = ircutils.toLower(channel)
+        format = format or 'csv'
+        if self._poll_info(channel, pollid) is None:
+            irc.error('That poll id does not exist')
+            return
+        # the buffered votes go in the export too
+        if self.vote_buffer.votes(channel, pollid):
+            self._flushVotes(poll=(channel, pollid))
+
+        dbfile = self.makeFilename(channel)
+        filename = conf.supybot.directories.data.dirize('Polls-%s-%s.%s' % (utils.file.sanitizeName(channel), pollid, format))
+        chunk = self.registryValue('export.chunk')
+
+        def run():
+            # a connection of its own, so the export doesnt hold up the other commands
+            db = sqlite3.connect(dbfile)
+            try:
+                with open(filename + '.tmp', 'w', newline='') as fd:
+                    votes = export.write(db, channel, pollid, fd, format, chunk)
+                os.replace(filename + '.tmp', filename)
+            except Exception as e:
+                self.log.exception('Exporting poll #%s of %s failed:' % (pollid, channel))
+                irc.error('Exporting poll #%s failed: %s' % (pollid, e))
+                return
+            finally:
+                db.close()
+            irc.reply('Exported poll #%s with %s votes to %s' % (pollid, votes, filename))
 
-        row = cursor.fetchone()
-        while row is not None:
-            irc.reply('Poll #%s: %s' % (row[0], row[1]), prefixNick=False, private=True)
-            irc.reply('The choices are as follows :- ', prefixNick=False, private=True)
-            cursorChoice = db.cursor()
-            self._execute_query(cursorChoice, 'SELECT choice_char,choice FROM choices WHERE poll_id=? ORDER BY choice_char', row[0])
-            choiceRow = cursorChoice.fetchone()
-            while choiceRow is not None:
-                irc.reply('%s: %s' % (choiceRow[0], choiceRow[1]), prefixNick=False, private=True)
-                choiceRow = cursorChoice.fetchone()
-            row = cursor.fetchone()
+        import threading
+        threading.Thread(target=run, name='Polls-export').start()
 
-    openpolls = wrap(openpolls, ['channeldb'])
+    exportpoll = wrap(dbthread(exportpoll), ['channeldb', 'Op', 'positiveInt', optional(('literal', export.FORMATS))])
 
     def pollon(self, irc, msg, args, channel, pollid, interval):
         """<[channel]> <id> <interval in minutes>
@@ -301,11 +1112,12 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
         <channel> is only necessary if the message is not sent in the channel
         itself."""
 
+        channel = ircutils.toLower(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
 
         # query to check poll exists, and if it is already on
-        pollinfo = self._poll_info(db, pollid)
+        pollinfo = self._poll_info(channel, pollid)
         if pollinfo is None:
             irc.error('That poll id does not exist')
             return
@@ -313,34 +1125,32 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
             irc.error('Poll is already active')
             return
 
-        # query to set poll off
-        db.execute('UPDATE polls SET isAnnouncing=? WHERE id=?', (1, pollid))
+        # query to set poll on
+        self._execute_query(cursor, 'UPDATE polls SET isAnnouncing=?, announce_interval=?, next_announce=? WHERE channel=? AND id=?',
+                            1, interval*60, time.time(), channel, pollid)
         db.commit()
+        self.poll_cache.invalidate(channel, pollid)
 
         if pollinfo[1] is not None:
             irc.reply('Note: you are turning on closed poll. I will not start announcing it')
             return
 
-        # function called by schedule event. can not have args
-        def runPoll():
-            self._runPoll(irc, channel, pollid)
-
-        # start schedule. will announce poll/choices to channel at interval
-        schedule.addPeriodicEvent(runPoll, interval*60, name='%s_poll_%s' % (channel, pollid))
-        self.poll_schedules.append('%s_poll_%s' % (channel, pollid))
+        # will announce poll/choices to channel now and at interval
+        self.announcer.add(irc.getRealIrc(), channel, pollid, interval*60)
 
-    pollon = wrap(pollon, ['channeldb', 'Op', 'positiveInt', 'positiveInt'])
+    pollon = wrap(dbthread(pollon), ['channeldb', 'Op', 'positiveInt', 'positiveInt'])
 
     def polloff(self, irc, msg, args, channel, pollid):
         """[<channel>] <id>
         Stops the poll with the given <id> from announcing. <channel> is
         only necessary if the message is not sent in the channel itself."""
 
+        channel = ircutils.toLower(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
 
         # query to grab poll info, then check it exists, isnt already off, and warn them if it is closed
-        pollinfo = self._poll_info(db, pollid)
+        pollinfo = self._poll_info(channel, pollid)
         if pollinfo is None:
             irc.error('That poll id does not exist')
             return
@@ -351,19 +1161,17 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
             irc.reply('Note: you are turning off a closed poll')
 
         # iquery to turn the poll "off", meaning it wont be scheduled to announce
-        self._execute_query(cursor, 'UPDATE polls SET isAnnouncing=? WHERE id=?', 0, pollid)
+        self._execute_query(cursor, 'UPDATE polls SET isAnnouncing=? WHERE channel=? AND id=?', 0, channel, pollid)
         db.commit()
+        self.poll_cache.invalidate(channel, pollid)
 
-        try:
-            schedule.removeEvent('%s_poll_%s' % (channel, pollid))
-            self.poll_schedules.remove('%s_poll_%s' % (channel, pollid))
-        except:
+        if not self.announcer.remove(channel, pollid):
             irc.error('Removing scedule failed')
             return
 
         irc.replySuccess()
 
-    polloff = wrap(polloff, ['channeldb', 'Op', 'positiveInt'])
+    polloff = wrap(dbthread(polloff), ['channeldb', 'Op', 'positiveInt'])
 
     def closepoll(self, irc, msg, args, channel, pollid):
         """[channel] <id>
@@ -371,11 +1179,10 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
         allowed. <channel> is only necessary if the message isn't sent in
         the channel itself."""
 
-        db = self.getDb(channel)
-        cursor = db.cursor()
+        channel = ircutils.toLower(channel)
 
         # query to check poll exists and if it is closed
-        pollinfo = self._poll_info(db, pollid)
+        pollinfo = self._poll_info(channel, pollid)
         if pollinfo is None:
             irc.error('Poll id doesnt exist')
             return
@@ -383,60 +1190,190 @@ class Polls(callbacks.Plugin, plugins.ChannelDBHandler):
             irc.error('Poll already closed on %s' % pollinfo[1].strftime('%Y-%m-%d at %-I:%M %p'))
             return
 
-        # close the poll in db
-        self._execute_query(cursor, 'UPDATE polls SET closed=? WHERE id=?', datetime.datetime.now(), pollid)
+        self._closePoll(channel, pollid, pollinfo)
+        irc.replySuccess()
+
+    closepoll = wrap(dbthread(closepoll), ['channeldb', 'Op', 'positiveInt'])
+
+    def _closePoll(self, channel, pollid, pollinfo):
+        """ Closes the open poll 'pollid' in 'channel', whose _poll_info is 'pollinfo',
+        and drops what was scheduled for it"""
+
+        # votes cast before closing still count
+        if self.vote_buffer.votes(channel, pollid):
+            self._flushVotes(poll=(channel, pollid))
+
+        # close the poll in db. the instant runoff of a ranked poll is counted once and kept
+        outcome = None
+        if pollinfo[4] == 'ranked':
+            outcome = self._outcome(channel, pollid).to_json()
+        db = self.getDb(channel)
+        self._execute_query(db.cursor(), 'UPDATE polls SET closed=?, outcome=? WHERE channel=? AND id=?', datetime.datetime.now(), outcome, channel, pollid)
         db.commit()
+        self.poll_cache.invalidate(channel, pollid)
 
-        try:
-            schedule.removeEvent('%s_poll_%s' % (channel, pollid))
-            self.poll_schedules.remove('%s_poll_%s' % (channel, pollid))
-        except:
-            self.log.warning('Failed to remove schedule event')
+        self.announcer.remove(channel, pollid)
+        self.live.forget(channel, pollid)
+        self.deadlines.remove(channel, pollid)
 
-        irc.replySuccess()
+    def _expirePoll(self, irc, channel, pollid):
+        """Run by the deadlines, closes the poll and announces its results to the channel"""
 
-    closepoll = wrap(closepoll, ['channeldb', 'Op', 'positiveInt'])
+        try:
+            pollinfo = self._poll_info(channel, pollid)
+            if pollinfo is None or pollinfo[1] is not None:
+                return
+            self._closePoll(channel, pollid, pollinfo)
+            result_lines = self._result_lines(channel, pollid, self._poll_info(channel, pollid),
+                                              lambda: self._tally(channel, pollid))
+        except Exception as e:
+            self.log.error('Failed to close poll #%s of %s at its deadline: %s' % (pollid, channel, e))
+            return
+        items = ['Poll #%s has closed: %s' % (pollid, pollinfo[2])] + result_lines
+        self.announcer.queue(irc, channel, self._packLines(items, self._lineLength(irc, channel)))
 
-    def openpoll(self, irc, msg, args, channel, pollid, interval):
-        """[<channel>] <id>
-        Starts announcing poll with the given <id> if set to active.
-        <channel> is only necessary if the message isn't sent in the channel
-        itself."""
+    def openpoll(self, irc, msg, args, channel, optlist, pollid, interval):
+        """[<channel>] [--closes <duration|date>] <id> [<interval in minutes>]
+        Opens the closed poll with the given <id> again and starts announcing
+        it if set to active. With --closes it closes by itself again, see
+        newpoll. <channel> is only necessary if the message isn't sent in the
+        channel itself."""
 
+        channel = ircutils.toLower(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
 
         # query to check poll exists and if it is open
-        pollinfo = self._poll_info(db, pollid)
+        pollinfo = self._poll_info(channel, pollid)
         if pollinfo is None:
             irc.error('Poll id doesnt exist')
             return
         if pollinfo[1] is None:
             irc.error('Poll is still open')
             return
+        if pollinfo[3] is not None:
+            irc.error('Poll was archived on %s, only its results are left' % pollinfo[3].strftime('%Y-%m-%d at %-I:%M %p'))
+            return
+        deadline = None
+        for (option, value) in optlist:
+            deadline = self._deadline(irc, value)
+            if deadline is None:
+                return
 
-        # query to OPEN IT UP! unsets closed time
-        self._execute_query(cursor, 'UPDATE polls SET closed=? WHERE id=?', None, pollid)
+        # query to OPEN IT UP! unsets closed time, and the outcome counted when it closed
+        self._execute_query(cursor, 'UPDATE polls SET closed=?, outcome=?, deadline=? WHERE channel=? AND id=?', None, None, deadline, channel, pollid)
         db.commit()
+        self.poll_cache.invalidate(channel, pollid)
+        if deadline is not None:
+            self.deadlines.add(irc.getRealIrc(), channel, pollid, deadline)
 
         # if poll was set active then start schedule for it
         if pollinfo[0] == 1:
             if interval is None:
-                irc.reply('Note: Poll set to active, but you didnt supply interval, using default of 10 minutes')
-                interval = 10
-            # function called by schedule event. can not have args
-            def runPoll():
-                self._runPoll(irc, channel, pollid)
+                self._execute_query(cursor, 'SELECT announce_interval FROM polls WHERE channel=? AND id=?', channel, pollid)
+                saved = cursor.fetchone()[0]
+                if saved:
+                    interval = saved // 60
+                else:
+                    irc.reply('Note: Poll set to active, but you didnt supply interval, using default of 10 minutes')
+                    interval = 10
+            self._execute_query(cursor, 'UPDATE polls SET announce_interval=?, next_announce=? WHERE channel=? AND id=?', interval*60, time.time(), channel, pollid)
+            # will announce poll/choices to channel now and at interval
+            self.announcer.add(irc.getRealIrc(), channel, pollid, interval*60)
+
+    openpoll = wrap(dbthread(openpoll), ['channeldb', 'Op', getopts({'closes': 'something'}), 'positiveInt', additional('positiveInt')])
+
+    def pollcache(self, irc, msg, args):
+        """takes no arguments
+
+        Shows the hit and miss counters of the poll metadata cache."""
+
+        lookups = self.poll_cache.hits + self.poll_cache.misses
+        irc.reply('Poll cache: %s hits, %s misses (%.1f%% hit rate), %s entries in %s channels' %
+                  (self.poll_cache.hits, self.poll_cache.misses,
+                   100.0 * self.poll_cache.hits / lookups if lookups else 0.0,
+                   len(self.poll_cache), len(self.poll_cache.channels)))
+
+    pollcache = wrap(pollcache, ['admin'])
+
+    def pollabuse(self, irc, msg, args, channel):
+        """[<channel>]
+
+        Shows who has been throttled the most for using vote and results too
+        fast in <channel>. <channel> is only necessary if the message isn't
+        sent in the channel itself."""
+
+        if self.limiter is None:
+            irc.error('Throttling is off')
+            return
+        denied = self.limiter.denied.get(channel)
+        if not denied:
+            irc.reply('Nobody has been throttled in %s' % channel)
+            return
+        irc.reply('%s throttled commands in %s: %s' % (sum(denied.values()), channel,
+                  ', '.join('%s (%s)' % item for item in denied.most_common(10))))
+
+    pollabuse = wrap(pollabuse, ['channel', 'Op'])
 
-            # start schedule. will announce poll/choices to channel at interval
-            schedule.addPeriodicEvent(runPoll, interval*60, name='%s_poll_%s' % (channel, pollid))
-            self.poll_schedules.append('%s_poll_%s' % (channel, pollid))
+    def pollstats(self, irc, msg, args, reset):
+        """[reset]
 
-    openpoll = wrap(openpoll, ['channeldb', 'Op', 'positiveInt', additional('positiveInt')])
+        Shows how long the SQL statements and commands of the plugin took, the rows
+        returned, the commits and the replies sent. With 'reset' the stats start over.
+        The stats are recorded when supybot.plugins.Polls.stats.enable is on."""
+
+        if self.stats is None:
+            irc.error('Stats are off, turn on supybot.plugins.Polls.stats.enable and reload the plugin')
+            return
+        if reset:
+            self.stats.reset()
+            irc.replySuccess()
+            return
+        irc.reply(self.stats.summary())
+
+    pollstats = wrap(dbthread(pollstats), ['owner', optional(('literal', ['reset']))])
+
+    def _logStats(self):
+        """Run by supybot schedule every stats.logInterval seconds"""
+
+        self.log.info('Polls stats: %s' % self.stats.summary())
 
     def die(self):
-        for schedule_name in self.poll_schedules:
-            schedule.removeEvent(schedule_name)
+        for name in (self.restore_event, self.maintenance_event, self.stats_event, self.archive_event):
+            remove_event(name) # one that ran already may still have its job waiting for the db thread
+        # on a reload the next instance takes over the connections and what is waiting
+        # (see _handOver and reload), else the buffered votes are written. either way
+        # after the db thread finishes what is queued
+        reloading = self.handover is not None
+        if reloading:
+            self.handover.update(self.db_executor.submit(self._handOver).result())
+        else:
+            self.db_executor.submit(self._flushVotes, retry=False).result()
+            if self.vote_buffer:
+                self.log.error('Dropping %s buffered votes that could not be written' % len(self.vote_buffer))
+        self.db_executor.submit(self.announcer.stop).result()
+        self.db_executor.submit(self.deadlines.stop).result()
+        self.db_executor.submit(self.live.stop).result()
+        self.db_executor.shutdown()
+        if not reloading:
+            for db in self.db_files.values():
+                db.close()
+        self.db_files.clear()
+        self.dbCache.clear()
+        callbacks.Plugin.die(self)
+
+
+
+def reload(x=None):
+    """The reload hook of Owner: called without 'x' on this module before it is reloaded, it
+    returns the dict the instance being unloaded leaves its state in. Called with that dict
+    on the reloaded package (see __init__.py), the next instance takes the state from it"""
+
+    if x is None:
+        Polls.handover = {}
+        return Polls.handover
+    Polls.handover = x
+
 
 Class = Polls
 
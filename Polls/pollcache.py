@@ -0,0 +1,68 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Per channel LRU cache of poll metadata and choices."""
+
+import collections
+
+import supybot.ircutils as ircutils
+
+
+class PollCache(object):
+    """Keeps the most recently used entries of each channel, up to 'size'
+    per channel. Entries are loaded on a miss by the function given to get()
+    and stay until they are invalidated or pushed out"""
+
+    def __init__(self, size):
+        self.size = size
+        self.channels = ircutils.IrcDict() # channel -> OrderedDict((kind, pollid) -> value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.channels.values())
+
+    def get(self, channel, kind, pollid, load):
+        """Returns the cached 'kind' entry for the poll, calling load() on a miss.
+        None is returned but not cached, so polls made later are seen"""
+
+        entries = self.channels.get(channel)
+        if entries is None:
+            entries = self.channels[channel] = collections.OrderedDict()
+        key = (kind, pollid)
+        try:
+            value = entries[key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            entries.move_to_end(key)
+            return value
+
+        value = load()
+        if value is not None:
+            entries[key] = value
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+        return value
+
+    def invalidate(self, channel, pollid=None):
+        """Drops the entries of 'pollid', or of the whole channel if it is None"""
+
+        if pollid is None:
+            self.channels.pop(channel, None)
+            return
+        entries = self.channels.get(channel)
+        if entries:
+            for key in [key for key in entries if key[1] == pollid]:
+                del entries[key]
+
+    def clear(self):
+        self.channels.clear()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
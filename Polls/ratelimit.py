@@ -0,0 +1,123 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Token buckets that keep a voter from flooding vote and results."""
+
+import time
+import functools
+import collections
+
+import supybot.ircutils as ircutils
+
+
+class Bucket(object):
+    """Tokens of one nick or host as of 'stamp'. 'warned' is set once the
+    voter has been told they are throttled, so the next refusals are silent"""
+
+    __slots__ = ('tokens', 'stamp', 'warned')
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+        self.warned = False
+
+
+class RateLimiter(object):
+    """A bucket for each nick and each host, a command takes a token from both.
+    At most 'size' buckets are kept, least recently used first out, and a
+    bucket that would be full again is dropped since a new one is the same.
+
+    Refusals are counted by channel and hostmask for the ops to see"""
+
+    def __init__(self, size):
+        self.size = size
+        self.buckets = collections.OrderedDict() # ('nick'|'host', value) -> Bucket, oldest first
+        self.denied = ircutils.IrcDict() # channel -> Counter(hostmask -> refusals)
+        self.allowed_total = 0
+        self.denied_total = 0
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def _bucket(self, key, rate, burst, now):
+        """Returns the bucket of 'key' refilled up to 'now'"""
+
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = Bucket(float(burst), now)
+        else:
+            bucket.tokens = min(float(burst), bucket.tokens + (now - bucket.stamp) * rate)
+            bucket.stamp = now
+        self.buckets[key] = bucket
+        return bucket
+
+    def _expire(self, rate, burst, now):
+        full = now - burst / rate
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.size and bucket.stamp > full:
+                break
+            del self.buckets[key]
+
+    def allow(self, channel, nick, host, rate, burst, now=None):
+        """Takes a token for the voter, 'rate' is in tokens per second. Returns True
+        if they had one, False if they are throttled and were already told so,
+        None if they are throttled and should be told"""
+
+        if now is None:
+            now = time.time()
+        buckets = [self._bucket(('nick', ircutils.toLower(nick)), rate, burst, now),
+                   self._bucket(('host', host), rate, burst, now)]
+        self._expire(rate, burst, now)
+
+        if all(bucket.tokens >= 1 for bucket in buckets):
+            for bucket in buckets:
+                bucket.tokens -= 1
+                bucket.warned = False
+            self.allowed_total += 1
+            return True
+
+        self.denied_total += 1
+        counter = self.denied.setdefault(channel, collections.Counter())
+        counter['%s!%s' % (nick, host)] += 1
+        if len(counter) > self.size:
+            # keep the worst half, counters of occasional offenders are not worth the memory
+            self.denied[channel] = collections.Counter(dict(counter.most_common(self.size // 2)))
+        if any(bucket.warned for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.warned = True
+        return None
+
+    def wait(self, nick, host, rate):
+        """Seconds until the voter has a token again"""
+
+        tokens = [bucket.tokens for bucket in (self.buckets.get(('nick', ircutils.toLower(nick))),
+                                               self.buckets.get(('host', host))) if bucket is not None]
+        return max(0.0, (1 - min(tokens or [1])) / rate)
+
+
+def throttled(f):
+    """Decorator for commands of a plugin with a 'limiter' (None when throttling is off) taking
+    a channel as their first argument, to be applied before dbthread. A throttled voter gets
+    one error, then their commands are ignored until they have a token again"""
+
+    @functools.wraps(f)
+    def newf(self, irc, msg, args, channel, *L, **kwargs):
+        if self.limiter is not None:
+            rate = self.registryValue('throttle.perMinute') / 60.0
+            allowed = self.limiter.allow(channel, msg.nick, msg.host, rate, self.registryValue('throttle.burst'))
+            if allowed is None:
+                irc.error('You are going too fast, try again in %d seconds' %
+                          (self.limiter.wait(msg.nick, msg.host, rate) + 1))
+            if not allowed:
+                return
+        return f(self, irc, msg, args, channel, *L, **kwargs)
+    return newf
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
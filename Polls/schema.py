@@ -0,0 +1,277 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Versioned schema for the Polls databases.
+
+The version a database is at is kept in PRAGMA user_version. Databases made
+before versioning are at 0 and already have the tables of version 1, so
+every step has to be safe to run on them."""
+
+import sqlite3
+
+
+def _rebuild_polls(db, channel):
+    """Moves polls to a table keyed on (channel, id), so polls of many
+    channels can share a db while each keeps its own ids"""
+
+    db.execute("""CREATE TABLE polls_new(
+                    channel TEXT NOT NULL,          -- lowercase channel the poll is in
+                    id INTEGER NOT NULL,            -- poll number in the channel
+                    started_time TIMESTAMP,         -- time when poll was created
+                    isAnnouncing INTEGER default 1, -- if poll is announcing to channel
+                    closed TIMESTAMP,               -- NULL by default, set to time when closed(no more voting allowed)
+                    question TEXT,
+                    announce_interval INTEGER,      -- seconds between announcements
+                    next_announce REAL,             -- unix time of the next announcement
+                    PRIMARY KEY (channel, id))""")
+    db.execute("""INSERT INTO polls_new SELECT ?, id, started_time, isAnnouncing, closed, question,
+                                               announce_interval, next_announce FROM polls""", (channel,))
+    db.execute('DROP TABLE polls')
+    db.execute('ALTER TABLE polls_new RENAME TO polls')
+
+
+def _fill_channel(db, channel):
+    """Sets the channel of the choices and votes of a per channel db"""
+
+    for table in ('choices', 'votes'):
+        db.execute('UPDATE %s SET channel=? WHERE channel IS NULL' % table, (channel,))
+
+
+def _poll_choices(poll):
+    """SQL for the choices of the poll row 'poll' as one text, for the full text index"""
+
+    return """coalesce((SELECT group_concat(choice, ' ') FROM choices c
+                        WHERE c.channel=%(poll)s.channel AND c.poll_id=%(poll)s.id),
+                       (SELECT group_concat(choice, ' ') FROM poll_summary s
+                        WHERE s.channel=%(poll)s.channel AND s.poll_id=%(poll)s.id), '')""" % {'poll': poll}
+
+
+# the triggers keeping poll_search up to date. the choices of a poll are added
+# as they are inserted, or taken from choices or the summary when the poll row
+# comes after them (importdbs, the backfill). archiving deletes the choices but
+# the poll stays searchable
+_SEARCH_TRIGGERS = (
+    """CREATE TRIGGER poll_search_insert AFTER INSERT ON polls BEGIN
+           INSERT INTO poll_search (rowid, channel, poll_id, question, choices)
+           VALUES (NEW.rowid, NEW.channel, NEW.id, NEW.question, %s);
+       END""" % _poll_choices('NEW'),
+    """CREATE TRIGGER poll_search_update AFTER UPDATE OF question ON polls BEGIN
+           UPDATE poll_search SET question=NEW.question WHERE rowid=NEW.rowid;
+       END""",
+    """CREATE TRIGGER poll_search_delete AFTER DELETE ON polls BEGIN
+           DELETE FROM poll_search WHERE rowid=OLD.rowid;
+       END""",
+    """CREATE TRIGGER poll_search_choice AFTER INSERT ON choices BEGIN
+           UPDATE poll_search SET choices=choices || ' ' || NEW.choice
+           WHERE rowid=(SELECT rowid FROM polls WHERE channel=NEW.channel AND id=NEW.poll_id);
+       END""",
+)
+
+
+def _create_search(db, channel):
+    """Creates the poll_search full text index, fills it and adds its triggers.
+    Does nothing when the sqlite has no FTS5, the table is tried in a savepoint
+    so the rest of the migration goes on without it"""
+
+    db.execute('SAVEPOINT search')
+    try:
+        db.execute("""CREATE VIRTUAL TABLE poll_search USING fts5(
+                        channel UNINDEXED, poll_id UNINDEXED, question, choices)""")
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+        db.execute('ROLLBACK TO search')
+        db.execute('RELEASE search')
+        return
+    db.execute('RELEASE search')
+    db.execute("""INSERT INTO poll_search (rowid, channel, poll_id, question, choices)
+                    SELECT rowid, channel, id, question, %s FROM polls""" % _poll_choices('polls'))
+    for trigger in _SEARCH_TRIGGERS:
+        db.execute(trigger)
+
+
+def has_search(db):
+    """Returns whether 'db' has the poll_search index, see _create_search"""
+
+    return db.execute("SELECT 1 FROM sqlite_master WHERE name='poll_search'").fetchone() is not None
+
+
+# each entry upgrades the schema by one version. entries are SQL strings or
+# functions taking the connection and the channel of the db (None for the db
+# shared by all channels), all run inside one transaction per version
+MIGRATIONS = [
+    # 1: the original tables
+    ("""CREATE TABLE IF NOT EXISTS polls(
+            id INTEGER PRIMARY KEY,
+            started_time TIMESTAMP,         -- time when poll was created
+            isAnnouncing INTEGER default 1, -- if poll is announcing to channel
+            closed TIMESTAMP,               -- NULL by default, set to time when closed(no more voting allowed)
+            question TEXT)""",
+     """CREATE TABLE IF NOT EXISTS choices(
+            poll_id INTEGER,
+            choice_char TEXT,
+            choice TEXT)""",
+     """CREATE TABLE IF NOT EXISTS votes(
+            id INTEGER PRIMARY KEY,
+            poll_id INTEGER,
+            voter_nick TEXT,
+            voter_host TEXT,
+            choice INTEGER,
+            time timestamp)"""),
+    # 2: indexes for the choice lookup and the duplicate vote check
+    ("""CREATE INDEX IF NOT EXISTS choices_poll ON choices(poll_id, choice_char)""",
+     """CREATE INDEX IF NOT EXISTS votes_poll_nick ON votes(poll_id, voter_nick)""",
+     """CREATE INDEX IF NOT EXISTS votes_poll_host ON votes(poll_id, voter_host)"""),
+    # 3: running vote count on each choice, kept up to date by triggers so the
+    # tally reads one row per choice instead of counting votes
+    ("""ALTER TABLE choices ADD COLUMN votes INTEGER NOT NULL DEFAULT 0""",
+     """UPDATE choices SET votes=(SELECT count(*) FROM votes v
+                                 WHERE v.poll_id=choices.poll_id AND v.choice=choices.choice_char)""",
+     """CREATE TRIGGER votes_count_insert AFTER INSERT ON votes BEGIN
+            UPDATE choices SET votes=votes+1 WHERE poll_id=NEW.poll_id AND choice_char=NEW.choice;
+        END""",
+     """CREATE TRIGGER votes_count_update AFTER UPDATE OF poll_id, choice ON votes BEGIN
+            UPDATE choices SET votes=votes-1 WHERE poll_id=OLD.poll_id AND choice_char=OLD.choice;
+            UPDATE choices SET votes=votes+1 WHERE poll_id=NEW.poll_id AND choice_char=NEW.choice;
+        END""",
+     """CREATE TRIGGER votes_count_delete AFTER DELETE ON votes BEGIN
+            UPDATE choices SET votes=votes-1 WHERE poll_id=OLD.poll_id AND choice_char=OLD.choice;
+        END"""),
+    # 4: announce schedule of each poll so it survives restarts, seconds
+    # between announcements and unix time of the next one. the partial index
+    # only holds the polls that are announcing
+    ("""ALTER TABLE polls ADD COLUMN announce_interval INTEGER""",
+     """ALTER TABLE polls ADD COLUMN next_announce REAL""",
+     """CREATE INDEX IF NOT EXISTS polls_announcing ON polls(next_announce, announce_interval)
+            WHERE isAnnouncing=1 AND closed IS NULL"""),
+    # 5: every row knows its channel, so one db can hold all channels. the
+    # indexes and vote counters are rebuilt to go by channel first
+    (_rebuild_polls,
+     """CREATE INDEX polls_announcing ON polls(next_announce, announce_interval)
+            WHERE isAnnouncing=1 AND closed IS NULL""",
+     """ALTER TABLE choices ADD COLUMN channel TEXT""",
+     """ALTER TABLE votes ADD COLUMN channel TEXT""",
+     _fill_channel,
+     """DROP INDEX choices_poll""",
+     """DROP INDEX votes_poll_nick""",
+     """DROP INDEX votes_poll_host""",
+     """CREATE INDEX choices_poll ON choices(channel, poll_id, choice_char)""",
+     """CREATE INDEX votes_poll_nick ON votes(channel, poll_id, voter_nick)""",
+     """CREATE INDEX votes_poll_host ON votes(channel, poll_id, voter_host)""",
+     """DROP TRIGGER votes_count_insert""",
+     """DROP TRIGGER votes_count_update""",
+     """DROP TRIGGER votes_count_delete""",
+     """CREATE TRIGGER votes_count_insert AFTER INSERT ON votes BEGIN
+            UPDATE choices SET votes=votes+1
+            WHERE channel=NEW.channel AND poll_id=NEW.poll_id AND choice_char=NEW.choice;
+        END""",
+     """CREATE TRIGGER votes_count_update AFTER UPDATE OF channel, poll_id, choice ON votes BEGIN
+            UPDATE choices SET votes=votes-1
+            WHERE channel=OLD.channel AND poll_id=OLD.poll_id AND choice_char=OLD.choice;
+            UPDATE choices SET votes=votes+1
+            WHERE channel=NEW.channel AND poll_id=NEW.poll_id AND choice_char=NEW.choice;
+        END""",
+     """CREATE TRIGGER votes_count_delete AFTER DELETE ON votes BEGIN
+            UPDATE choices SET votes=votes-1
+            WHERE channel=OLD.channel AND poll_id=OLD.poll_id AND choice_char=OLD.choice;
+        END"""),
+    # 6: closed polls can be rolled up into the final tallies of poll_summary,
+    # polls.archived is when that happened. polls_closed finds the ones to do
+    ("""ALTER TABLE polls ADD COLUMN archived TIMESTAMP""",
+     """CREATE TABLE poll_summary(
+            channel TEXT NOT NULL,
+            poll_id INTEGER NOT NULL,
+            choice_char TEXT NOT NULL,
+            choice TEXT,
+            votes INTEGER,
+            PRIMARY KEY (channel, poll_id, choice_char)) WITHOUT ROWID""",
+     """CREATE INDEX polls_closed ON polls(closed) WHERE closed IS NOT NULL AND archived IS NULL"""),
+    # 7: approval and ranked polls. votes.choice holds the letters of the
+    # ballot, in order of preference for ranked polls, and the counters count
+    # every ballot with the choice on it. polls.outcome is the instant runoff
+    # of a closed ranked poll, see tabulate.py
+    ("""ALTER TABLE polls ADD COLUMN kind TEXT NOT NULL DEFAULT 'single'""",
+     """ALTER TABLE polls ADD COLUMN outcome TEXT""",
+     """DROP TRIGGER votes_count_insert""",
+     """DROP TRIGGER votes_count_update""",
+     """DROP TRIGGER votes_count_delete""",
+     """CREATE TRIGGER votes_count_insert AFTER INSERT ON votes BEGIN
+            UPDATE choices SET votes=votes+1
+            WHERE channel=NEW.channel AND poll_id=NEW.poll_id AND instr(NEW.choice, choice_char) > 0;
+        END""",
+     """CREATE TRIGGER votes_count_update AFTER UPDATE OF channel, poll_id, choice ON votes BEGIN
+            UPDATE choices SET votes=votes-1
+            WHERE channel=OLD.channel AND poll_id=OLD.poll_id AND instr(OLD.choice, choice_char) > 0;
+            UPDATE choices SET votes=votes+1
+            WHERE channel=NEW.channel AND poll_id=NEW.poll_id AND instr(NEW.choice, choice_char) > 0;
+        END""",
+     """CREATE TRIGGER votes_count_delete AFTER DELETE ON votes BEGIN
+            UPDATE choices SET votes=votes-1
+            WHERE channel=OLD.channel AND poll_id=OLD.poll_id AND instr(OLD.choice, choice_char) > 0;
+        END"""),
+    # 8: unix time an open poll closes by itself. the partial index only holds
+    # the open polls that have one, they are read back when the db is opened
+    ("""ALTER TABLE polls ADD COLUMN deadline REAL""",
+     """CREATE INDEX polls_deadline ON polls(deadline) WHERE deadline IS NOT NULL AND closed IS NULL"""),
+    # 9: full text index of the question and choices of every poll, a row per
+    # poll with the rowid of its polls row, see search.py. left out when the
+    # sqlite has no FTS5
+    (_create_search,),
+    # 10: votes.voter_key tells voters apart, see voterkey.py. the unique
+    # index replaces the nick and host ones so vote is a single upsert,
+    # previous_choice is the choice the last change of a vote replaced and is
+    # read back by it. the key depends on the voterIdentity of the channel, so
+    # the plugin gives the existing votes theirs, found with votes_unkeyed
+    ("""ALTER TABLE votes ADD COLUMN voter_key TEXT""",
+     """ALTER TABLE votes ADD COLUMN previous_choice TEXT""",
+     """DROP INDEX votes_poll_nick""",
+     """DROP INDEX votes_poll_host""",
+     """CREATE UNIQUE INDEX votes_voter ON votes(channel, poll_id, voter_key)""",
+     """CREATE INDEX votes_unkeyed ON votes(id) WHERE voter_key IS NULL"""),
+]
+
+VERSION = len(MIGRATIONS)
+
+
+def version(db):
+    """Returns the schema version of 'db'"""
+
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db, channel=None):
+    """Upgrades 'db' to VERSION, one transaction per version. 'channel' is the
+    lowercase channel of a per channel db, None for the db shared by all channels.
+    Returns the version it was at before"""
+
+    start = version(db)
+    if start > VERSION:
+        raise ValueError('Database schema version %s is newer than this plugin (%s)' % (start, VERSION))
+
+    isolation_level = db.isolation_level
+    db.isolation_level = None # manage the transactions ourselves, DDL included
+    try:
+        for number in range(start + 1, VERSION + 1):
+            db.execute('BEGIN')
+            try:
+                for step in MIGRATIONS[number - 1]:
+                    if callable(step):
+                        step(db, channel)
+                    else:
+                        db.execute(step)
+                db.execute('PRAGMA user_version = %d' % number)
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+    finally:
+        db.isolation_level = isolation_level
+
+    return start
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
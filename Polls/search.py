@@ -0,0 +1,82 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Full text search of the questions and choices of the polls, through the
+poll_search table kept up to date by triggers (see schema.py)."""
+
+import datetime
+
+STATUSES = ('open', 'closed')
+
+# the polls of the index that match, joined on the rowid of their polls row
+SEARCH_QUERY = """SELECT %s FROM poll_search s JOIN polls p ON p.rowid=s.rowid
+                  WHERE poll_search MATCH ?"""
+
+COLUMNS = 'p.channel, p.id, p.question, p.started_time, p.closed'
+
+
+def match_query(text):
+    """Returns the FTS5 query matching the polls with all the words of 'text',
+    None if it has none. The words are quoted so FTS5 operators and punctuation
+    are taken as they are, a trailing * still matches the words starting with it"""
+
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"%s"%s' % (word.replace('"', '""'), '*' if prefix else ''))
+    return ' '.join(terms) or None
+
+
+def parse_date(text):
+    """Returns the datetime of the 'YYYY-MM-DD' 'text', raises ValueError if it isnt one"""
+
+    return datetime.datetime.strptime(text, '%Y-%m-%d')
+
+
+def query(match, channel=None, status=None, since=None, until=None, count=False):
+    """Returns (sql, args) for the polls matching the FTS5 query 'match'. The
+    polls can be narrowed to the lowercase 'channel', a 'status' of STATUSES
+    and to those started from the day 'since' to the day 'until', both datetimes.
+
+    With 'count' the sql counts them, else it selects COLUMNS most recent first
+    and takes a LIMIT and an OFFSET after the args"""
+
+    sql = SEARCH_QUERY % ('count(*)' if count else COLUMNS)
+    args = [match]
+    if channel is not None:
+        sql += ' AND p.channel=?'
+        args.append(channel)
+    if status == 'open':
+        sql += ' AND p.closed IS NULL'
+    elif status == 'closed':
+        sql += ' AND p.closed IS NOT NULL'
+    if since is not None:
+        sql += ' AND p.started_time >= ?'
+        args.append(since)
+    if until is not None:
+        sql += ' AND p.started_time < ?'
+        args.append(until + datetime.timedelta(days=1))
+    if not count:
+        sql += ' ORDER BY p.started_time DESC, p.channel, p.id LIMIT ? OFFSET ?'
+    return sql, args
+
+
+def merge(results, limit):
+    """Merges the rows of COLUMNS found in several dbs, each most recent first,
+    and returns the first 'limit' of them in the same order"""
+
+    rows = []
+    for result in results:
+        rows.extend(result)
+    rows.sort(key=lambda row: (row[0], row[1]))
+    rows.sort(key=lambda row: row[3] or datetime.datetime.min, reverse=True)
+    return rows[:limit]
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -0,0 +1,158 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Timings and counters of the SQL statements and commands of the plugin."""
+
+import time
+import functools
+
+
+class Histogram(object):
+    """Durations in buckets of BOUNDS milliseconds, the last bucket is for
+    anything slower. Percentiles are the upper bound of their bucket"""
+
+    BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0   # seconds
+        self.slowest = 0.0 # seconds
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.slowest = max(self.slowest, seconds)
+        ms = seconds * 1000
+        for i, bound in enumerate(self.BOUNDS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, p):
+        """Milliseconds that 'p' percent of the durations are within"""
+
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.slowest * 1000
+        return self.slowest * 1000
+
+    def summary(self):
+        return '%s in %.1fms (p50 %sms, p99 %sms, max %.1fms)' % (self.count, self.total * 1000,
+                                                                  self.percentile(50), self.percentile(99),
+                                                                  self.slowest * 1000)
+
+
+class Stats(object):
+    """What the plugin has done since it was loaded or the stats were reset:
+    a Histogram per SQL statement and per command, the rows the statements
+    returned, the commits and the replies of each command"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.statements = {} # normalized SQL -> Histogram
+        self.rows = {}       # normalized SQL -> rows returned
+        self.commands = {}   # command name -> Histogram
+        self.replies = {}    # command name -> replies sent
+        self.commits = 0
+
+    def statement(self, sql, seconds):
+        """Records one run of 'sql', returns its key for row()"""
+
+        key = ' '.join(sql.split())
+        histogram = self.statements.get(key)
+        if histogram is None:
+            histogram = self.statements[key] = Histogram()
+            self.rows[key] = 0
+        histogram.add(seconds)
+        return key
+
+    def row(self, key):
+        self.rows[key] += 1
+
+    def command(self, name, seconds):
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands[name] = Histogram()
+        histogram.add(seconds)
+
+    def reply(self, name, n=1):
+        self.replies[name] = self.replies.get(name, 0) + n
+
+    def summary(self, top=5):
+        """One line of the totals, the commands and the 'top' statements by total time"""
+
+        queries = sum(h.count for h in self.statements.values())
+        parts = ['%s statements, %s rows, %s commits in %s' % (queries, sum(self.rows.values()), self.commits,
+                                                               _duration(time.time() - self.since))]
+        for name, histogram in sorted(self.commands.items()):
+            parts.append('%s: %s, %s replies' % (name, histogram.summary(), self.replies.get(name, 0)))
+        slowest = sorted(self.statements.items(), key=lambda item: -item[1].total)[:top]
+        for sql, histogram in slowest:
+            parts.append('%s: %s, %s rows' % (sql[:60], histogram.summary(), self.rows[sql]))
+        return ' | '.join(parts)
+
+
+def _duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return '%sm%ss' % (seconds // 60, seconds % 60)
+    return '%sh%sm' % (seconds // 3600, seconds % 3600 // 60)
+
+
+class ReplyCounter(object):
+    """Stands in for the irc of a command, counting the replies and errors it sends"""
+
+    def __init__(self, irc, stats, name):
+        self._irc = irc
+        self._stats = stats
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._irc, attr)
+
+    def reply(self, *args, **kwargs):
+        self._stats.reply(self._name)
+        return self._irc.reply(*args, **kwargs)
+
+    def error(self, *args, **kwargs):
+        self._stats.reply(self._name)
+        return self._irc.error(*args, **kwargs)
+
+    def replySuccess(self, *args, **kwargs):
+        self._stats.reply(self._name)
+        return self._irc.replySuccess(*args, **kwargs)
+
+
+def timed(f):
+    """Decorator for commands of a plugin with a 'stats' (None when disabled),
+    to be applied before dbthread. Records how long the command took and its replies"""
+
+    name = f.__name__
+
+    @functools.wraps(f)
+    def newf(self, irc, *args, **kwargs):
+        if self.stats is None:
+            return f(self, irc, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return f(self, ReplyCounter(irc, self.stats, name), *args, **kwargs)
+        finally:
+            self.stats.command(name, time.perf_counter() - start)
+    return newf
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
@@ -0,0 +1,144 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Instant runoff tabulation of the ranked polls.
+
+A ballot is the string of choice letters in order of preference, as kept in
+votes.choice. The ballots are read once, identical ones are counted together
+and each distinct ballot becomes a bytes of choice indexes. Each round only
+the ballots of the eliminated choice are moved to their next choice still in,
+so the whole count goes over every ballot about once whatever the number of
+rounds."""
+
+import json
+import collections
+
+# the ballots of a poll, one row each
+BALLOTS_QUERY = """SELECT choice FROM votes WHERE channel=? AND poll_id=?"""
+
+
+class Outcome(object):
+    """Rounds of an instant runoff
+
+    ::ballots:: Integer number of ballots counted
+    ::rounds:: list of (counts, exhausted, eliminated). counts is [(choice_char, votes), ...]
+               of the choices still in, most votes first. exhausted is the number of
+               ballots with none of them left, eliminated the choice_chars dropped after the round
+    ::winner:: choice_char, None if there were no ballots
+    ::names:: dict of choice_char -> choice"""
+
+    __slots__ = ('ballots', 'rounds', 'winner', 'names')
+
+    def __init__(self, ballots, rounds, winner, names):
+        self.ballots = ballots
+        self.rounds = rounds
+        self.winner = winner
+        self.names = names
+
+    def result_lines(self):
+        """'Round N: A 10, B 7 - B out' for each round, then the winner"""
+
+        lines = ['%s ballots' % self.ballots]
+        for number, (counts, exhausted, eliminated) in enumerate(self.rounds, start=1):
+            line = 'Round %s: %s' % (number, ', '.join('%s %s' % count for count in counts))
+            if exhausted:
+                line += ', %s exhausted' % exhausted
+            if eliminated:
+                line += ' - %s out' % ', '.join(eliminated)
+            lines.append(line)
+        if self.winner is None:
+            lines.append('No winner')
+        else:
+            lines.append('Winner: %s: %s' % (self.winner, self.names[self.winner]))
+        return lines
+
+    def to_json(self):
+        return json.dumps({'ballots': self.ballots, 'rounds': self.rounds,
+                           'winner': self.winner, 'names': self.names})
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        rounds = [([tuple(count) for count in counts], exhausted, eliminated)
+                  for counts, exhausted, eliminated in data['rounds']]
+        return cls(data['ballots'], rounds, data['winner'], data['names'])
+
+
+def irv(choices, ballots):
+    """Runs an instant runoff over 'ballots', an iterable of ballot strings, for
+    'choices', the [(choice_char, choice, ...), ...] of the poll (a tally.Tally
+    will do). Returns an Outcome.
+
+    The choice with the fewest votes is eliminated each round, choices without
+    any all at once. Ties go to the one with fewer first round votes, then to
+    the later letter. A choice wins with more than half the ballots not yet
+    exhausted, or by being the last one in"""
+
+    chars = [row[0] for row in choices]
+    names = dict((row[0], row[1]) for row in choices)
+    index = dict((char, i) for i, char in enumerate(chars))
+
+    # identical ballots are counted once, with their number as weight
+    rankings = []
+    weights = []
+    for ballot, weight in collections.Counter(ballots).items():
+        rankings.append(bytes(index[char] for char in ballot if char in index))
+        weights.append(weight)
+
+    counts = [0] * len(chars)
+    piles = [[] for char in chars] # choice index -> ballots whose current choice it is
+    position = [0] * len(rankings) # ballot -> place of its current choice in its ranking
+    exhausted = 0
+    for ballot, ranking in enumerate(rankings):
+        if ranking:
+            counts[ranking[0]] += weights[ballot]
+            piles[ranking[0]].append(ballot)
+        else:
+            exhausted += weights[ballot]
+    first = list(counts)
+
+    continuing = set(range(len(chars)))
+    rounds = []
+    winner = None
+    while continuing:
+        standing = sorted(continuing, key=lambda i: (-counts[i], i))
+        active = sum(counts[i] for i in standing)
+        leader = standing[0]
+        if not active or len(standing) == 1 or counts[leader] * 2 > active:
+            rounds.append(([(chars[i], counts[i]) for i in standing], exhausted, []))
+            if active:
+                winner = chars[leader]
+            break
+
+        lowest = counts[standing[-1]]
+        if lowest == 0:
+            out = [i for i in standing if counts[i] == 0]
+        else:
+            out = [min((i for i in standing if counts[i] == lowest), key=lambda i: (first[i], -i))]
+        rounds.append(([(chars[i], counts[i]) for i in standing], exhausted, [chars[i] for i in out]))
+        continuing.difference_update(out)
+
+        # only the ballots of the eliminated choices move
+        for i in out:
+            for ballot in piles[i]:
+                ranking = rankings[ballot]
+                place = position[ballot] + 1
+                while place < len(ranking) and ranking[place] not in continuing:
+                    place += 1
+                position[ballot] = place
+                if place < len(ranking):
+                    counts[ranking[place]] += weights[ballot]
+                    piles[ranking[place]].append(ballot)
+                else:
+                    exhausted += weights[ballot]
+            piles[i] = []
+            counts[i] = 0
+
+    return Outcome(sum(weights), rounds, winner, names)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
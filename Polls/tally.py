@@ -0,0 +1,91 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""Vote tallying shared by the Polls commands and the announcer."""
+
+# choices.votes is kept up to date by triggers on votes (see schema.py), so
+# counting a poll reads one row per choice no matter how many votes it has
+TALLY_QUERY = """SELECT choice_char, choice, votes FROM choices
+                 WHERE channel=? AND poll_id=? ORDER BY choice_char"""
+
+# same shape as TALLY_QUERY, for polls that have been archived. their
+# choices and votes are gone and only the final tally is kept
+SUMMARY_QUERY = """SELECT choice_char, choice, votes FROM poll_summary
+                   WHERE channel=? AND poll_id=? ORDER BY choice_char"""
+
+# same shape as TALLY_QUERY, for when only the choices are needed
+CHOICES_QUERY = """SELECT choice_char, choice, NULL FROM choices
+                   WHERE channel=? AND poll_id=? ORDER BY choice_char"""
+
+
+class Tally(object):
+    """Choices of a poll along with how many votes each one got
+
+    ::pollid:: Integer
+    ::choices:: list of (choice_char, choice, votes) ordered by choice_char,
+                votes is None if the tally was made without counting
+    ::total:: Integer sum of all votes"""
+
+    __slots__ = ('pollid', 'choices', 'total')
+
+    def __init__(self, pollid, rows):
+        self.pollid = pollid
+        self.choices = [tuple(row) for row in rows]
+        self.total = sum(row[2] or 0 for row in self.choices)
+
+    def __len__(self):
+        return len(self.choices)
+
+    def __iter__(self):
+        return iter(self.choices)
+
+    def __contains__(self, choice_char):
+        return any(row[0] == choice_char for row in self.choices)
+
+    def count(self, choice_char):
+        """Returns the number of votes for 'choice_char', or None if it isnt a choice"""
+        for row in self.choices:
+            if row[0] == choice_char:
+                return row[2] or 0
+        return None
+
+    def add(self, choice_char, votes):
+        """Adds 'votes' (can be negative) to the count of 'choice_char'"""
+        for i, row in enumerate(self.choices):
+            if row[0] == choice_char:
+                self.choices[i] = (row[0], row[1], (row[2] or 0) + votes)
+                self.total += votes
+                return
+
+    def choice_lines(self):
+        """'A: answer' for each choice"""
+        return ['%s: %s' % (row[0], row[1]) for row in self.choices]
+
+    def result_lines(self):
+        """'A: answer - N votes' for each choice"""
+        return ['%s: %s - %s votes' % (row[0], row[1], row[2] or 0) for row in self.choices]
+
+
+def tally(cursor, channel, pollid, counts=True, execute=None):
+    """Runs the tally for 'pollid' in the lowercase 'channel' on 'cursor' and
+    returns a Tally, from the summary if the poll was archived. If 'counts' is
+    False only the choices are fetched and the vote counts are None. The Tally
+    has no choices if the poll doesnt exist.
+
+    execute(cursor, sql, *args) runs the queries, cursor.execute by default"""
+
+    if execute is None:
+        execute = lambda cursor, sql, *args: cursor.execute(sql, args)
+    execute(cursor, TALLY_QUERY if counts else CHOICES_QUERY, channel, pollid)
+    rows = cursor.fetchall()
+    if not rows and counts:
+        execute(cursor, SUMMARY_QUERY, channel, pollid)
+        rows = cursor.fetchall()
+    return Tally(pollid, rows)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
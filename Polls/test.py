@@ -5,10 +5,724 @@
 #
 ###
 
+import io
+import contextlib
+import os
+import time
+import datetime
+import json
+import sqlite3
+
 from supybot.test import *
+import supybot.schedule as schedule
+
+from . import tally
+from . import schema
+from . import ratelimit
+from . import export
+from . import tabulate
+from . import deadlines
+from . import search
+from . import voterkey
+# skipped unless POLLS_LOADTEST is set, see loadtest.py
+from .loadtest import PollsLoadTestCase
 
-class PollsTestCase(PluginTestCase):
+class PollsTestCase(ChannelPluginTestCase):
     plugins = ('Polls',)
 
+    def _drain(self):
+        """Returns the text of every message waiting in the queue"""
+        lines = []
+        m = self.irc.takeMsg()
+        while m is not None:
+            lines.append(m.args[1])
+            m = self.irc.takeMsg()
+        return lines
+
+    def testVoteTally(self):
+        self.assertResponse('newpoll 5 "yes,no,maybe" Is it?', 'Started new poll #1')
+        self.assertEqual(self._drain(), ['Poll #1: Is it? | A: yes | B: no | C: maybe',
+                                         'To vote, do @vote 1 <choice letter>'])
+        self.assertRegexp('vote 1 b', 'poll #1 for B has been inputed')
+        self.assertEqual(self._drain(), ['Here is results for poll #1, you just voted for B: '
+                                         'A: yes - 0 votes | B: no - 1 votes | C: maybe - 0 votes'])
+        self.assertError('vote 1 D')
+        self.assertError('vote 1 B')
+        self.assertRegexp('vote 1 c', 'poll #1 for C has been inputed')
+        self.assertEqual(self._drain(), ['Here is results for poll #1, you just voted for C: '
+                                         'A: yes - 0 votes | B: no - 0 votes | C: maybe - 1 votes'])
+        self.assertError('results 2')
+
+    def testNewPollRollback(self):
+        db = self.irc.getCallback('Polls').getDb(self.channel)
+        db.execute("CREATE TEMP TRIGGER fail BEFORE INSERT ON choices BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+        self.assertError('newpoll 5 "yes,no" Is it?')
+        self.assertFalse(db.in_transaction)
+        db.execute('DROP TRIGGER fail')
+        self.assertResponse('newpoll 5 "yes,no" Is it?', 'Started new poll #1')
+
+    def testRankedVote(self):
+        cb = self.irc.getCallback('Polls')
+        self.assertResponse('newpoll --ranked 5 "a,b,c" Pick?', 'Started new poll #1')
+        self.assertEqual(self._drain(), ['Poll #1 (ranked): Pick? | A: a | B: b | C: c',
+                                         'To vote, do @vote 1 <choice letters, most preferred first>'])
+        self.assertRegexp('vote 1 a a', 'only once')
+        self.assertRegexp('vote 1 a b', 'poll #1 for A B has been inputed')
+        self.assertEqual(self._drain(), ['Here is results for poll #1, you just voted for A B: '
+                                         '1 ballots | Round 1: A 1, B 0, C 0 | Winner: A: a'])
+        for frm, ballot in (('u2!u@two.example', 'b a'), ('u3!u@three.example', 'c a'), ('u4!u@four.example', 'a')):
+            self.assertNotError('vote 1 %s' % ballot, frm=frm)
+            self._drain()
+        results = ('Here is results for poll #1: 4 ballots | Round 1: A 2, B 1, C 1 - C out | '
+                   'Round 2: A 3, B 1 | Winner: A: a')
+        self.assertResponse('results 1', results)
+        self.assertNotError('closepoll 1')
+        db = cb.getDb(self.channel)
+        self.assertNotEqual(db.execute('SELECT outcome FROM polls WHERE id=1').fetchone()[0], None)
+        # counted when it closed, not from the votes left
+        db.execute("DELETE FROM votes WHERE voter_nick != 'test'")
+        self.assertResponse('results 1', results)
+
+    def testApprovalVote(self):
+        self.assertNotError('newpoll --approval 5 "x,y,z" Which?')
+        self.assertNotError('newpoll 5 "yes,no" Single?')
+        self._drain()
+        self.assertRegexp('vote 2 a b', 'one choice')
+        self.assertRegexp('vote 1 c a', 'poll #1 for A C has been inputed')
+        self.assertEqual(self._drain(), ['Here is results for poll #1, you just voted for A C: '
+                                         'A: x - 1 votes | B: y - 0 votes | C: z - 1 votes'])
+        self.assertRegexp('vote 1 a c', 'already voted for A C')
+        self.assertNotError('vote 1 b')
+        self.assertEqual(self._drain(), ['Here is results for poll #1, you just voted for B: '
+                                         'A: x - 0 votes | B: y - 1 votes | C: z - 0 votes'])
+
+    def testInstantRunoff(self):
+        choices = [('A', 'a', None), ('B', 'b', None), ('C', 'c', None)]
+        outcome = tabulate.irv(choices, ['C', 'C', 'A', 'B', 'BA'] * 10000)
+        self.assertEqual(outcome.ballots, 50000)
+        self.assertEqual(outcome.rounds, [([('B', 20000), ('C', 20000), ('A', 10000)], 0, ['A']),
+                                          ([('B', 20000), ('C', 20000)], 10000, ['C']),
+                                          ([('B', 20000)], 30000, [])])
+        self.assertEqual(outcome.winner, 'B')
+        self.assertEqual(tabulate.Outcome.from_json(outcome.to_json()).result_lines(), outcome.result_lines())
+        self.assertEqual(tabulate.irv(choices, []).result_lines(), ['0 ballots', 'Round 1: A 0, B 0, C 0', 'No winner'])
+
+    def testDeadline(self):
+        self.assertEqual(deadlines.parse('1h30m', now=1000), 6400)
+        self.assertEqual(deadlines.parse('2026-05-01T18:00'), time.mktime((2026, 5, 1, 18, 0, 0, 0, 0, -1)))
+        self.assertRaises(ValueError, deadlines.parse, 'soon')
+
+        cb = self.irc.getCallback('Polls')
+        self.assertRegexp('newpoll --closes soon 5 "yes,no" Is it?', 'not a valid duration')
+        self.assertRegexp('newpoll --closes 1h 5 "yes,no" Is it?', 'Started new poll #1, it closes on')
+        self._drain()
+        self.assertRegexp('newpoll --closes 2h 5 "yes,no" Is it too?', 'Started new poll #2')
+        self._drain()
+        self.assertEqual(len(cb.deadlines), 2)
+        self.assertEqual(cb.deadlines.event_time, cb.deadlines.deadline(self.channel, 1))
+        self.assertNotError('vote 1 a')
+        self.assertNotError('closepoll 2')
+        self._drain()
+        self.assertEqual(len(cb.deadlines), 1)
+
+        cb.announcer.tokens = 5
+        cb.deadlines.add(self.irc, self.channel, 1, time.time() - 1)
+        cb.deadlines.tick()
+        self.assertEqual(self._drain(), ['Poll #1 has closed: Is it? | A: yes - 1 votes | B: no - 0 votes'])
+        self.assertNotEqual(cb._poll_info(self.channel, 1)[1], None)
+        self.assertEqual((len(cb.deadlines), cb.deadlines.event), (0, None))
+
+        self.assertNotError('openpoll --closes 30m 1')
+        self._drain()
+        self.assertNotError('reload Polls')
+        cb = self.irc.getCallback('Polls')
+        cb._restoreSchedules()
+        self.assertEqual(list(cb.deadlines.polls), [(self.channel, 1)])
+        plan = self._plan(cb.getDb(self.channel), 'SELECT channel,id,deadline FROM polls '
+                                                  'WHERE deadline IS NOT NULL AND closed IS NULL')
+        self.assertIn('polls_deadline', plan)
+
+        # a deadline that passed before the tick got to it
+        self.assertNotError('newpoll --closes 1h 5 "yes,no" Again?')
+        self._drain()
+        db = cb.getDb(self.channel)
+        db.execute('UPDATE polls SET deadline=? WHERE id=3', (time.time() - 1,))
+        cb.poll_cache.invalidate(self.channel, 3)
+        lines = [self.getMsg('vote 3 a').args[1]] + self._drain()
+        self.assertEqual(len([line for line in lines if 'Error: This poll closed on' in line]), 1)
+        self.assertNotEqual(cb._poll_info(self.channel, 3)[1], None)
+
+        # one that passed while the db was not open is closed when it is
+        db.execute('UPDATE polls SET deadline=? WHERE id=1', (time.time() - 1,))
+        self.assertNotError('unload Polls')
+        self.assertNotError('load Polls')
+        lines = [self.getMsg('vote 1 b').args[1]] + self._drain()
+        self.assertEqual(len([line for line in lines if 'Error: This poll was closed on' in line]), 1)
+        self.assertEqual(len(self.irc.getCallback('Polls').deadlines), 0)
+
+    def testSearchPolls(self):
+        self.assertNotError('newpoll 5 "cheese,pineapple" Best pizza topping?')
+        self.assertNotError('newpoll 5 "monday,friday" Meeting day?')
+        self.assertNotError('newpoll #other 5 "pepperoni,ham" Pizza for the party?')
+        self.assertNotError('closepoll 2')
+        self._drain()
+        self.assertResponse('searchpolls pineapple', '1 polls, page 1 of 1: #test #1: Best pizza topping? (open)')
+        self.assertResponse('searchpolls pizza', '2 polls, page 1 of 1: #other #1: Pizza for the party? (open) | '
+                                                 '#test #1: Best pizza topping? (open)')
+        self.assertResponse('searchpolls --channel #test pizz*', '1 polls, page 1 of 1: #test #1: Best pizza topping? (open)')
+        self.assertRegexp('searchpolls --closed day', r'^1 polls, page 1 of 1: #test #2: Meeting day\? \(closed \d{4}-\d\d-\d\d\)$')
+        self.assertResponse('searchpolls --open --since 2000-01-01 --until 2000-12-31 pizza', 'No polls match that')
+        self.assertRegexp('searchpolls --since yesterday pizza', 'not a valid date')
+        with conf.supybot.plugins.Polls.search.pageSize.context(1):
+            self.assertResponse('searchpolls --page 2 pizza', '2 polls, page 2 of 2: #test #1: Best pizza topping? (open)')
+            self.assertRegexp('searchpolls --page 3 pizza', 'only 2 pages')
+
+        cb = self.irc.getCallback('Polls')
+        sql, args = search.query(search.match_query('pizza'), self.channel, 'open')
+        plan = self._plan(cb.getDb(self.channel), sql.replace('?', "''"))
+        self.assertIn('VIRTUAL TABLE', plan)
+
+        self.assertResponse('searchpolls --channel #nowhere pizza', 'No polls match that')
+        self.assertFalse(os.path.exists(cb.makeFilename('#nowhere')))
+
+        conf.supybot.plugins.Polls.storage.setValue('single')
+        try:
+            self.assertNotError('reload Polls')
+            self.assertNotError('newpoll #other 5 "pepperoni,ham" Pizza for the party?')
+            self._drain()
+            self.assertResponse('searchpolls pizza', '1 polls, page 1 of 1: #other #1: Pizza for the party? (open)')
+            self.assertResponse('searchpolls --channel #test pizza', 'No polls match that')
+        finally:
+            conf.supybot.plugins.Polls.storage.setValue('channel')
+
+    def testSearchWithoutFts5(self):
+        class NoFts5(sqlite3.Connection):
+            def execute(self, sql, *args):
+                if 'fts5' in sql:
+                    raise sqlite3.OperationalError('no such module: fts5')
+                return sqlite3.Connection.execute(self, sql, *args)
+
+        cb = self.irc.getCallback('Polls')
+        db = sqlite3.connect(cb.makeFilename('#nofts'), factory=NoFts5)
+        schema.migrate(db, '#nofts')
+        self.assertEqual(schema.version(db), schema.VERSION)
+        self.assertFalse(schema.has_search(db))
+        db.close()
+
+        self.assertNotError('newpoll #nofts 5 "cheese,pineapple" Best pizza topping?')
+        self._drain()
+        self.assertRegexp('searchpolls --channel #nofts pizza', 'needs the FTS5 module')
+
+    def testVoterIdentity(self):
+        msg = ircmsgs.privmsg(self.channel, 'vote 1 a', prefix='Nick!user@Cloak.example')
+        self.assertEqual(voterkey.key('host', msg), 'host:cloak.example')
+        self.assertEqual(voterkey.key('nickhost', msg), 'nickhost:nick@cloak.example')
+        self.assertEqual(voterkey.key('account', msg), 'host:cloak.example')
+        msg.server_tags['account'] = 'Someone'
+        self.assertEqual(voterkey.key('account', msg), 'account:someone')
+
+        cb = self.irc.getCallback('Polls')
+        db = cb.getDb(self.channel)
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self._drain()
+        self.assertNotError('vote 1 a', frm='one!u@cloak.example')
+        self._drain()
+        self.assertRegexp('vote 1 a', 'already voted for A', frm='two!u@cloak.example')
+        self.assertNotError('vote 1 b', frm='two!u@cloak.example')
+        self._drain()
+        self.assertEqual(db.execute('SELECT voter_nick,choice,previous_choice FROM votes').fetchall(), [('two', 'B', 'A')])
+        with conf.supybot.plugins.Polls.voterIdentity.context('nickhost'):
+            self.assertNotError('vote 1 a', frm='one!u@cloak.example')
+            self._drain()
+        self.assertEqual(cb._tally(self.channel, 1).choices, [('A', 'yes', 1), ('B', 'no', 1)])
+
+        # without RETURNING the replaced choice is read first
+        cb.RETURNING = False
+        self.assertNotError('vote 1 b', frm='three!u@three.example')
+        self._drain()
+        self.assertRegexp('vote 1 b', 'already voted for B', frm='three!u@three.example')
+        self.assertNotError('vote 1 a', frm='three!u@three.example')
+        self._drain()
+        self.assertEqual(cb._tally(self.channel, 1).choices, [('A', 'yes', 2), ('B', 'no', 1)])
+        del cb.RETURNING
+
+        # votes from before there were keys get the key of the identity of their channel
+        insert = "INSERT INTO votes (channel,poll_id,voter_nick,voter_host,choice,time) VALUES ('#test',1,?,?,'B',?)"
+        db.execute(insert, ('Old[1]', 'old.example', datetime.datetime.now()))
+        with conf.supybot.plugins.Polls.voterIdentity.context('nickhost'):
+            cb._keyVotes(db)
+            self.assertRegexp('vote 1 b', 'already voted for B', frm='old{1}!u@old.example')
+        # with the account identity the next vote from their host takes theirs over
+        db.execute(insert, ('legacy', 'legacy.example', datetime.datetime.now()))
+        with conf.supybot.plugins.Polls.voterIdentity.context('account'):
+            cb._keyVotes(db)
+            self.assertEqual(db.execute("SELECT count(*) FROM votes WHERE voter_key='legacy:legacy.example'").fetchone()[0], 1)
+            self.assertRegexp('vote 1 b', 'already voted for B', frm='new!u@legacy.example')
+        self.assertEqual(db.execute('SELECT count(*) FROM votes WHERE voter_key IS NULL').fetchone()[0], 0)
+
+    def testBufferedVotes(self):
+        cb = self.irc.getCallback('Polls')
+        db = cb.getDb(self.channel)
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self._drain()
+        self.assertNotError('vote 1 a')
+        self._drain()
+        with conf.supybot.plugins.Polls.buffer.enable.context(True):
+            self.assertNotError('vote 1 a', frm='other!o@other.example')
+            self.assertTrue(self._drain()[0].endswith('A: yes - 2 votes | B: no - 0 votes'))
+            self.assertRegexp('vote 1 a', 'already voted for A', frm='other!o@other.example')
+            self.assertNotError('vote 1 b')
+            self._drain()
+            self.assertEqual(db.execute('SELECT count(*) FROM votes').fetchone()[0], 1)
+            self.assertRegexp('results 1', 'A: yes - 1 votes \| B: no - 1 votes$', frm='other!o@other.example')
+            # votes on other kinds of polls go to the db and leave the buffer alone
+            self.assertNotError('newpoll --approval 5 "x,y" Which?')
+            self._drain()
+            self.assertNotError('vote 2 a b')
+            self._drain()
+            self.assertEqual(len(cb.vote_buffer), 2)
+            # a failed write keeps the votes for the next flush
+            db.execute("CREATE TEMP TRIGGER fail BEFORE INSERT ON votes BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+            cb._flushVotes()
+            self.assertEqual(len(cb.vote_buffer), 2)
+            self.assertNotEqual(cb.flush_event, None)
+            db.execute('DROP TRIGGER fail')
+            cb._flushVotes()
+        self.assertEqual((len(cb.vote_buffer), cb.flush_event), (0, None))
+        self.assertEqual(cb._tally(self.channel, 1).choices, [('A', 'yes', 1), ('B', 'no', 1)])
+        self.assertEqual(db.execute('SELECT count(*) FROM votes').fetchone()[0], 3)
+
+    def testAnnouncer(self):
+        cb = self.irc.getCallback('Polls')
+        with conf.supybot.plugins.Polls.announce.burst.context(100):
+            cb.announcer.tokens = 100
+            self.assertNotError('newpoll 5 "%s" First?' % ','.join(['x' * 100] * 5))
+            self.assertEqual(len(self._drain()), 3)
+            self.assertNotError('newpoll 10 "yes,no" Second?')
+            self._drain()
+            self.assertEqual(len(cb.announcer), 2)
+            for entry in cb.announcer.polls.values():
+                entry.due = 0
+            cb.announcer.heap = [(0, '#test', 1), (0, '#test', 2)]
+            cb.announcer.tick()
+            lines = self._drain()
+            self.assertEqual(lines[-2:], ['Poll #2: Second? | A: yes | B: no',
+                                          'To vote, do @vote <poll id> <choice letter>'])
+            self.assertTrue(all(len(line) <= cb._lineLength(self.irc, self.channel) for line in lines))
+        self.assertNotError('closepoll 1')
+        self.assertEqual(len(cb.announcer), 1)
+        # an interval within announce.mergeWindow is announced once per tick
+        self.assertNotError('newpoll 1 "yes,no" Often?')
+        self.assertAlmostEqual(cb.announcer.entry(self.channel, 3).due, time.time() + 60, delta=5)
+
+    def testAnnounceRate(self):
+        cb = self.irc.getCallback('Polls')
+        cb.announcer.tokens = 3
+        self.assertNotError('newpoll 5 "yes,no" First?')
+        self.assertNotError('newpoll 5 "yes,no" Second?')
+        self.assertEqual(len(cb.announcer.lines), 1)
+        self.assertNotEqual(cb.announcer.send_event, None)
+
+    def testRestoreSchedules(self):
+        self.assertNotError('newpoll 5 "yes,no" First?')
+        self.assertNotError('newpoll 5 "yes,no" Second?')
+        self.assertNotError('newpoll 5 "yes,no" Third?')
+        self.assertNotError('polloff 2')
+        self.assertNotError('closepoll 3')
+        due = self.irc.getCallback('Polls').announcer.entry(self.channel, 1).due
+        self.assertNotError('unload Polls')
+        self.assertNotError('load Polls')
+        self._drain()
+        cb = self.irc.getCallback('Polls')
+        self.assertEqual(len(cb.announcer), 0)
+        self.assertIn(self.channel, cb.unrestored.values())
+        cb._restoreSchedules()
+        self.assertEqual(len(cb.unrestored), 0)
+        self.assertEqual(len(cb.announcer), 1)
+        entry = cb.announcer.entry(self.channel, 1)
+        self.assertEqual((entry.interval, entry.due), (300, due))
+        plan = self._plan(cb.getDb(self.channel), 'SELECT channel,id,announce_interval,next_announce FROM polls '
+                                                  'WHERE isAnnouncing=1 AND closed IS NULL')
+        self.assertIn('polls_announcing', plan)
+
+    # seconds loading and reloading the plugin may take, with RELOAD_CHANNELS db files
+    LOAD_BUDGET = 0.5
+    RELOAD_CHANNELS = 20
+
+    def testReload(self):
+        for i in range(self.RELOAD_CHANNELS):
+            self.assertNotError('newpoll #chan%s --closes 1d 5 "yes,no" Here?' % i)
+        self._drain()
+        cb = self.irc.getCallback('Polls')
+        with conf.supybot.plugins.Polls.buffer.enable.context(True):
+            self.assertNotError('vote #chan0 1 a')
+        self._drain()
+        with conf.supybot.plugins.Polls.live.enable.context(True):
+            self.assertNotError('pollwatch #chan1 1')
+            self.assertNotError('vote #chan1 1 b')
+        self._drain()
+        dbs = dict(cb.db_files)
+        dues = dict((key, entry.due) for key, entry in cb.announcer.polls.items())
+
+        start = time.perf_counter()
+        self.assertNotError('reload Polls')
+        self.assertLess(time.perf_counter() - start, self.LOAD_BUDGET)
+        new = self.irc.getCallback('Polls')
+        self.assertIsNot(new, cb)
+        # the connections, schedules and buffered vote carry over, nothing is opened or scheduled twice
+        self.assertEqual(new.db_files, dbs)
+        self.assertEqual(len(new.unrestored), 0)
+        self.assertEqual(dict((key, entry.due) for key, entry in new.announcer.polls.items()), dues)
+        self.assertEqual(len(new.deadlines), self.RELOAD_CHANNELS)
+        self.assertEqual(len(new.vote_buffer), 1)
+        names = [event for event in schedule.schedule.events if event.startswith('Polls')]
+        self.assertEqual(sorted(names), sorted(set(names)))
+        self.assertIn('Polls_flush_votes', names)
+        new._flushVotes()
+        self.assertEqual(new.getDb('#chan0').execute('SELECT count(*) FROM votes').fetchone()[0], 1)
+        # so do the running tally, its pending push and the watchers
+        self.assertIn('Polls_live_#chan1_1', names)
+        new.live.push(('#chan1', 1))
+        self.assertEqual(new.announcer.lines[-1][1:], ('test', 'Poll #1: B +1 (1) | 1 votes'))
+        self.assertEqual(new.handover, None)
+
+        # a fresh load opens nothing until the restore event gets to it
+        self.assertNotError('unload Polls')
+        start = time.perf_counter()
+        self.assertNotError('load Polls')
+        self.assertLess(time.perf_counter() - start, self.LOAD_BUDGET)
+        new = self.irc.getCallback('Polls')
+        self.assertEqual((len(new.db_files), len(new.unrestored)), (0, self.RELOAD_CHANNELS))
+
+    def testCompactOutput(self):
+        self.assertRegexp('openpolls', 'no open polls')
+        for i in range(30):
+            self.assertNotError('newpoll 5 "yes,no,maybe,never,always" Question %s?' % i)
+        self._drain()
+        self.assertRegexp('openpolls', r'^Poll #1: Question 0\? \(A: yes, B: no, C: maybe, D: never, '
+                                       r'E: always\) \| Poll #2: .*\(\d+ more messages\)')
+        self.assertRegexp('more', r'Poll #\d+')
+
+    def testDbThread(self):
+        conf.supybot.plugins.Polls.dbThread.setValue(True)
+        try:
+            self.assertNotError('reload Polls')
+            cb = self.irc.getCallback('Polls')
+            self.assertTrue(cb.db_executor.threaded)
+            self.assertResponse('newpoll 5 "yes,no" Is it?', 'Started new poll #1')
+            self._drain()
+            self.assertRegexp('vote 1 a', 'has been inputed')
+            # the results PM is sent from the db thread right after
+            m = self.irc.takeMsg()
+            while m is None:
+                time.sleep(0.01)
+                m = self.irc.takeMsg()
+            self.assertIn('A: yes - 1 votes', m.args[1])
+            self.assertRegexp('results 1', 'Here is results for poll #1: A: yes - 1 votes')
+            # an event that fired but whose job has not run yet is gone from the schedule
+            schedule.removeEvent(cb.archive_event)
+            self.assertNotError('reload Polls')
+        finally:
+            conf.supybot.plugins.Polls.dbThread.setValue(False)
+
+    def testPollCache(self):
+        cb = self.irc.getCallback('Polls')
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self._drain()
+        self.assertNotError('vote 1 a')
+        self._drain()
+        hits = cb.poll_cache.hits
+        self.assertNotError('vote 1 b')
+        self._drain()
+        self.assertEqual(cb.poll_cache.hits, hits + 2)
+        self.assertNotError('closepoll 1')
+        self.assertRegexp('vote 1 a', 'This poll was closed')
+        self.assertRegexp('pollcache', r'\d+ hits, \d+ misses')
+
+    def testThrottle(self):
+        cb = self.irc.getCallback('Polls')
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self._drain()
+        self.assertRegexp('pollabuse', 'Nobody has been throttled')
+        with conf.supybot.plugins.Polls.throttle.burst.context(2):
+            for choice in 'ab':
+                self.assertNotError('vote 1 %s' % choice)
+                self._drain()
+            self.assertRegexp('vote 1 a', 'going too fast')
+            # told once, then ignored
+            self.assertNoResponse('results 1', 0.1)
+            # the host has its own bucket, already told
+            self.assertNoResponse('vote 1 a', 0.1, frm='othernick!%s' % self.prefix.split('!')[1])
+            self.assertRegexp('pollabuse', r'^3 throttled commands in #test: test!\S+ \(2\), othernick!\S+ \(1\)$')
+            self.assertEqual(cb._tally(self.channel, 1).choices, [('A', 'yes', 0), ('B', 'no', 1)])
+
+        limiter = ratelimit.RateLimiter(2)
+        self.assertTrue(limiter.allow('#c', 'a', 'ha', 1.0, 1, now=0))
+        self.assertIsNone(limiter.allow('#c', 'a', 'ha', 1.0, 1, now=0.5))
+        self.assertFalse(limiter.allow('#c', 'a', 'ha', 1.0, 1, now=0.6))
+        self.assertTrue(limiter.allow('#c', 'a', 'ha', 1.0, 1, now=1.1))
+        limiter.allow('#c', 'b', 'hb', 1.0, 1, now=1.2)
+        self.assertEqual(len(limiter), 2)
+        # everything is full again, so forgotten
+        limiter.allow('#c', 'c', 'hc', 1.0, 1, now=10)
+        self.assertEqual(list(limiter.buckets), [('nick', 'c'), ('host', 'hc')])
+
+    def testLiveResults(self):
+        cb = self.irc.getCallback('Polls')
+        other = 'other!o@other.example'
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self._drain()
+        self.assertRegexp('pollwatch 1', 'not on')
+        with conf.supybot.plugins.Polls.live.enable.context(True):
+            self.assertRegexp('pollwatch 1', 'You will get the live results of poll #1')
+            self.assertResponse('vote 1 a', 'Your vote on poll #1 for A has been inputed')
+            self.assertResponse('vote 1 b', 'Your vote on poll #1 for B has been inputed', frm=other)
+            self.assertEqual(self._drain(), [])
+            poll = cb.live.polls[('#test', 1)]
+            self.assertNotEqual(poll.event, None)
+            cb.live.push(('#test', 1))
+            m = self.irc.takeMsg()
+            self.assertEqual(m.args, ('test', 'Poll #1: A +1 (1), B +1 (1) | 2 votes'))
+            self.assertNotError('vote 1 a', frm=other)
+            cb.live.push(('#test', 1))
+            self.assertEqual(self._drain(), ['Poll #1: A +1 (2), B -1 (0) | 2 votes'])
+            self.assertEqual(cb._tally(self.channel, 1).count('A'), 2)
+            self.assertNotError('newpoll --approval 5 "x,y" Which?')
+            self._drain()
+            self.assertRegexp('pollwatch 2', 'Only single choice polls')
+        # a vote the running tally misses drops the tally, the watchers stay
+        self.assertNotError('vote 1 b', frm='third!t@third.example')
+        self._drain()
+        self.assertEqual((len(cb.live), list(cb.live.subscribers[('#test', 1)])), (0, ['test']))
+        self.assertNotError('closepoll 1')
+        self.assertEqual(cb.live.subscribers, {})
+
+    def testExport(self):
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self._drain()
+        self.assertNotError('vote 1 b')
+        self.assertNotError('vote 1 a', frm='other!o@other.example')
+        self._drain()
+        self.assertError('exportpoll 2')
+        self.feedMsg('@exportpoll 1 jsonl')
+        m = self.irc.takeMsg()
+        while m is None:
+            time.sleep(0.01)
+            m = self.irc.takeMsg()
+        self.assertIn('Exported poll #1 with 2 votes to ', m.args[1])
+        with open(m.args[1].split(' to ', 1)[1]) as fd:
+            records = [json.loads(line) for line in fd]
+        self.assertEqual([r['record'] for r in records], ['poll', 'choice', 'choice', 'vote', 'vote'])
+        self.assertEqual(records[0]['question'], 'Is it?')
+        self.assertEqual([(r['choice'], r['votes']) for r in records[1:3]], [('A', 1), ('B', 1)])
+        self.assertEqual(set((r['voter_nick'], r['choice']) for r in records[3:]), set([('test', 'B'), ('other', 'A')]))
+
+        out = io.StringIO()
+        db = self.irc.getCallback('Polls').getDb(self.channel)
+        self.assertEqual(export.write(db, self.channel, 1, out, 'csv', chunk=1), 2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], ','.join(export.FIELDS))
+        self.assertEqual(len(lines), 6)
+
+        # the script finds the channel whatever its case, and checks the poll before writing anything
+        from . import exportpoll
+        filename = self.irc.getCallback('Polls').makeFilename(self.channel)
+        output = os.path.join(os.path.dirname(filename), 'poll.csv')
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            self.assertRaises(SystemExit, exportpoll.main, [filename, '#TEST', '2', '--output', output])
+            self.assertFalse(os.path.exists(output))
+            exportpoll.main([filename, '#TEST', '1', '--output', output])
+        self.assertEqual(err.getvalue().splitlines(), ['No poll #2 in #test', '2 votes exported'])
+        with open(output) as fd:
+            self.assertEqual(len(fd.read().splitlines()), 6)
+
+    def testImportDbs(self):
+        from . import importdbs
+        other = 'other!o@other.example'
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self.assertNotError('newpoll 5 "red,blue" Colour?')
+        self.assertNotError('newpoll #other 5 "up,down" Which way?')
+        self._drain()
+        self.assertNotError('vote 2 b')
+        self.assertNotError('vote 2 a', frm=other)
+        self.assertNotError('vote #other 1 a', frm=other)
+        self._drain()
+
+        datadir = conf.supybot.directories.data()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            importdbs.main([datadir, '--batch', '1'])
+            importdbs.main([datadir])
+        self.assertEqual(out.getvalue().splitlines(), ['#other: 1 polls, 1 votes', '#test: 2 polls, 2 votes',
+                                                       '#other: already imported', '#test: already imported'])
+        db = sqlite3.connect(os.path.join(datadir, importdbs.FILENAME))
+        self.assertEqual(db.execute('SELECT channel,id,question FROM polls ORDER BY channel,id').fetchall(),
+                         [('#other', 1, 'Which way?'), ('#test', 1, 'Is it?'), ('#test', 2, 'Colour?')])
+        self.assertEqual(db.execute('SELECT channel,poll_id,choice_char,choice,votes FROM choices '
+                                    'ORDER BY channel,poll_id,choice_char').fetchall(),
+                         [('#other', 1, 'A', 'up', 1), ('#other', 1, 'B', 'down', 0),
+                          ('#test', 1, 'A', 'yes', 0), ('#test', 1, 'B', 'no', 0),
+                          ('#test', 2, 'A', 'red', 1), ('#test', 2, 'B', 'blue', 1)])
+        self.assertEqual(db.execute('SELECT channel,poll_id,voter_nick,choice FROM votes '
+                                    'ORDER BY channel,poll_id,voter_nick').fetchall(),
+                         [('#other', 1, 'other', 'A'), ('#test', 2, 'other', 'A'), ('#test', 2, 'test', 'B')])
+        db.close()
+
+        conf.supybot.plugins.Polls.storage.setValue('single')
+        try:
+            self.assertNotError('reload Polls')
+            self._drain()
+            self.assertResponse('results 2', 'Here is results for poll #2: A: red - 1 votes | B: blue - 1 votes')
+            self.assertRegexp('vote 2 b', 'already voted for B')
+        finally:
+            conf.supybot.plugins.Polls.storage.setValue('channel')
+
+    def testArchive(self):
+        cb = self.irc.getCallback('Polls')
+        other = 'other!o@other.example'
+        self.assertNotError('newpoll 5 "yes,no" Is it?')
+        self.assertNotError('newpoll 5 "yes,no" Still open?')
+        self._drain()
+        self.assertNotError('vote 1 a')
+        self.assertNotError('vote 1 b', frm=other)
+        self._drain()
+        self.assertNotError('closepoll 1')
+        db = cb.getDb(self.channel)
+        self.assertEqual(db.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        db.execute('UPDATE polls SET closed=? WHERE id=1', (datetime.datetime.now() - datetime.timedelta(days=10),))
+        cb.poll_cache.clear()
+
+        cb._archivePolls()
+        self.assertEqual(db.execute('SELECT count(*) FROM poll_summary').fetchone()[0], 0)
+        with conf.supybot.plugins.Polls.retention.graceDays.context(7):
+            cb._archivePolls()
+        self.assertNotEqual(cb.archive_event, None)
+        self.assertEqual(db.execute('SELECT count(*) FROM votes').fetchone()[0], 0)
+        self.assertEqual(db.execute('SELECT count(*) FROM choices WHERE poll_id=1').fetchone()[0], 0)
+        self.assertEqual(db.execute('SELECT archived IS NOT NULL FROM polls ORDER BY id').fetchall(), [(1,), (0,)])
+        archive = sqlite3.connect(cb.makeFilename(self.channel).replace('Polls.db', 'Polls-archive.db'))
+        self.assertEqual(archive.execute('SELECT voter_nick,choice FROM votes ORDER BY choice').fetchall(),
+                         [('test', 'A'), ('other', 'B')])
+        archive.close()
+
+        self.assertResponse('results 1', 'Here is results for poll #1: A: yes - 1 votes | B: no - 1 votes',
+                            frm='nobody!n@nobody.example')
+        self.assertRegexp('openpoll 1', 'archived')
+        self.assertRegexp('vote 2 a', 'has been inputed')
+
+        # a file that is not open is opened for the sweep only
+        self.assertNotError('newpoll #cold 5 "yes,no" Cold?')
+        self._drain()
+        self.assertNotError('closepoll #cold 1')
+        filename = cb.makeFilename('#cold')
+        cold = cb.db_files.pop(filename)
+        cold.execute('UPDATE polls SET closed=? WHERE id=1', (datetime.datetime.now() - datetime.timedelta(days=10),))
+        cold.close()
+        cb.dbCache.pop('#cold')
+        cb.poll_cache.clear()
+        with conf.supybot.plugins.Polls.retention.graceDays.context(7):
+            cb._archivePolls()
+        self.assertNotIn(filename, cb.db_files)
+        cold = sqlite3.connect(filename)
+        self.assertEqual(cold.execute('SELECT archived IS NOT NULL FROM polls').fetchall(), [(1,)])
+        cold.close()
+
+    def testStats(self):
+        self.assertRegexp('pollstats', 'Stats are off')
+        with conf.supybot.plugins.Polls.stats.enable.context(True):
+            self.assertNotError('reload Polls')
+            cb = self.irc.getCallback('Polls')
+            self.assertNotError('newpoll 5 "yes,no" Is it?')
+            self._drain()
+            self.assertNotError('vote 1 a')
+            self._drain()
+            self.assertNotError('results 1')
+            self.assertNotError('openpolls')
+            self.assertEqual(cb.stats.commands['vote'].count, 1)
+            self.assertEqual(cb.stats.replies['vote'], 2)
+            self.assertEqual(cb.stats.replies['_announce'], 2)
+            self.assertEqual(cb.stats.rows[' '.join(tally.TALLY_QUERY.split())], 4)
+            self.assertGreaterEqual(cb.stats.commits, 3)
+            self.assertRegexp('pollstats', r'^\d+ statements, \d+ rows, \d+ commits .*vote: 1 in')
+            self.assertNotError('pollstats reset')
+            self.assertEqual(cb.stats.commands, {})
+        self.assertNotError('reload Polls')
+
+    def testPragmas(self):
+        cb = self.irc.getCallback('Polls')
+        db = cb.getDb(self.channel)
+        self.assertEqual(db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(db.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(db.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+        cb._maintainDbs()
+
+    def _plan(self, db, query, *args):
+        """Returns the EXPLAIN QUERY PLAN details for 'query' joined together"""
+        rows = db.execute('EXPLAIN QUERY PLAN ' + query, args).fetchall()
+        return ' / '.join(row[-1] for row in rows)
+
+    def testQueryPlans(self):
+        cb = self.irc.getCallback('Polls')
+        db = cb.getDb(self.channel)
+        plan = self._plan(db, 'SELECT choice,time FROM votes WHERE ' + cb.VOTER_WHERE, '#test', 1, 'host:host')
+        self.assertIn('USING INDEX votes_voter', plan)
+        plan = self._plan(db, 'SELECT * FROM choices WHERE channel=? AND poll_id=? AND choice_char=?', '#test', 1, 'A')
+        self.assertIn('USING INDEX choices_poll', plan)
+        plan = self._plan(db, tally.TALLY_QUERY, '#test', 1)
+        self.assertIn('USING INDEX choices_poll', plan)
+        self.assertNotIn('votes', plan)
+
+    def testMigrateLegacyDb(self):
+        cb = self.irc.getCallback('Polls')
+        channel = '#legacy'
+        legacy = sqlite3.connect(cb.makeFilename(channel))
+        legacy.execute('CREATE TABLE polls(id INTEGER PRIMARY KEY, started_time TIMESTAMP, '
+                       'isAnnouncing INTEGER default 1, closed TIMESTAMP, question TEXT)')
+        legacy.execute('CREATE TABLE choices(poll_id INTEGER, choice_char TEXT, choice TEXT)')
+        legacy.execute('CREATE TABLE votes(id INTEGER PRIMARY KEY, poll_id INTEGER, voter_nick TEXT, '
+                       'voter_host TEXT, choice INTEGER, time timestamp)')
+        legacy.execute("INSERT INTO polls VALUES (1, NULL, 0, NULL, 'old?')")
+        legacy.execute("INSERT INTO choices VALUES (1, 'A', 'yes')")
+        legacy.execute("INSERT INTO votes VALUES (NULL, 1, 'nick', 'host', 'A', NULL)")
+        # a nick change that got a second vote in, only the latest is kept
+        legacy.execute("INSERT INTO votes VALUES (NULL, 1, 'nick_', 'Host', 'A', NULL)")
+        legacy.commit()
+        legacy.close()
+
+        db = cb.getDb(channel)
+        self.assertEqual(db.execute('PRAGMA user_version').fetchone()[0], schema.VERSION)
+        indexes = set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+        self.assertTrue(set(['choices_poll', 'votes_voter']) <= indexes)
+        self.assertEqual(db.execute('SELECT voter_key FROM votes').fetchall(), [('host:host',)])
+        self.assertEqual(cb._poll_info(channel, 1)[2], 'old?')
+        self.assertEqual(cb._tally(channel, 1).count('A'), 1)
+        self.assertEqual(db.execute('SELECT DISTINCT channel FROM votes').fetchall(), [(channel,)])
+        self.assertEqual(db.execute("SELECT poll_id FROM poll_search WHERE poll_search MATCH 'old yes'").fetchall(), [(1,)])
+
+    def testSingleStorage(self):
+        conf.supybot.plugins.Polls.storage.setValue('single')
+        try:
+            self.assertNotError('reload Polls')
+            cb = self.irc.getCallback('Polls')
+            for command, reply in [('newpoll 5 "yes,no" Here?', '#1'),
+                                   ('newpoll #other 5 "yes,no" There?', '#1'),
+                                   ('newpoll #OTHER 5 "yes,no" Again?', '#2')]:
+                self.assertResponse(command, 'Started new poll ' + reply)
+                self._drain()
+            self.assertNotError('vote #other 1 b')
+            self._drain()
+            self.assertIs(cb.getDb(self.channel), cb.getDb('#other'))
+            self.assertEqual(list(cb.db_files), [conf.supybot.directories.data.dirize('Polls.db')])
+            self.assertEqual(cb._tally('#other', 1).count('B'), 1)
+            self.assertEqual(cb._tally(self.channel, 1).count('B'), 0)
+            self.assertRegexp('openpolls', r'^Poll #1: Here\? \(A: yes, B: no\)$')
+            self.assertNotError('reload Polls')
+            cb = self.irc.getCallback('Polls')
+            cb._restoreSchedules()
+            self.assertEqual(len(cb.announcer), 3)
+        finally:
+            conf.supybot.plugins.Polls.storage.setValue('channel')
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,89 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""In memory layer that holds votes until they are written in a batch."""
+
+import supybot.ircutils as ircutils
+
+
+class PendingVote(object):
+    """A vote not yet written to the db
+
+    ::key:: voter_key of the voter, see voterkey.py
+    ::old_choice:: choice of the vote it replaces in the db, None for a new vote"""
+
+    __slots__ = ('pollid', 'key', 'nick', 'host', 'choice', 'time', 'old_choice')
+
+    def __init__(self, pollid, key, nick, host, choice, time, old_choice=None):
+        self.pollid = pollid
+        self.key = key
+        self.nick = nick
+        self.host = host
+        self.choice = choice
+        self.time = time
+        self.old_choice = old_choice
+
+
+class VoteBuffer(object):
+    """Pending votes by channel and poll, looked up the same way as
+    the votes table: by voter_key"""
+
+    def __init__(self):
+        self.channels = ircutils.IrcDict() # channel -> {pollid -> {voter_key -> PendingVote}}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def find(self, channel, pollid, key):
+        """Returns the PendingVote of the voter on the poll, or None"""
+
+        return self.channels.get(channel, {}).get(pollid, {}).get(key)
+
+    def add(self, channel, vote):
+        """Buffers 'vote', replacing what the same voter had pending on that poll"""
+
+        voters = self.channels.setdefault(channel, {}).setdefault(vote.pollid, {})
+        if vote.key not in voters:
+            self.size += 1
+        voters[vote.key] = vote
+
+    def votes(self, channel, pollid):
+        """Returns the distinct pending votes of a poll"""
+
+        return list(self.channels.get(channel, {}).get(pollid, {}).values())
+
+    def adjust(self, channel, poll_tally):
+        """Adds the pending votes of the poll to 'poll_tally' (a tally.Tally), returns it"""
+
+        for vote in self.votes(channel, poll_tally.pollid):
+            poll_tally.add(vote.choice, 1)
+            if vote.old_choice is not None:
+                poll_tally.add(vote.old_choice, -1)
+        return poll_tally
+
+    def take(self, channel=None, pollid=None):
+        """Empties the buffer, or only takes the votes of 'pollid' in 'channel'
+        if given, returns [(channel, [PendingVote, ...]), ...]"""
+
+        if channel is not None:
+            voters = self.channels.get(channel, {}).pop(pollid, {})
+            self.size -= len(voters)
+            return [(channel, list(voters.values()))] if voters else []
+
+        taken = []
+        for channel, polls in self.channels.items():
+            pending = []
+            for pollid in polls:
+                pending.extend(self.votes(channel, pollid))
+            taken.append((channel, pending))
+        self.channels.clear()
+        self.size = 0
+        return taken
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
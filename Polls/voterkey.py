@@ -0,0 +1,64 @@
+###
+# Copyright (c) 2012, DAn
+# All rights reserved.
+#
+#
+###
+
+"""The key that tells voters apart, votes.voter_key.
+
+Each strategy of the voterIdentity setting makes one lowercase key per
+message, prefixed with what it is made of so keys of different strategies
+never match each other."""
+
+import supybot.ircdb as ircdb
+import supybot.ircutils as ircutils
+
+
+def host_key(host):
+    """Key of the 'host' strategy"""
+
+    return 'host:' + host.lower()
+
+
+def nickhost_key(nick, host):
+    """Key of the 'nickhost' strategy"""
+
+    return 'nickhost:%s@%s' % (ircutils.toLower(nick), host.lower())
+
+
+def legacy_key(strategy, nick, host):
+    """Key for 'strategy' of a vote cast by 'nick' from 'host' before there
+    were keys. The account a vote came from was not kept, those of the
+    'account' strategy get a key that the voter claims with their next vote"""
+
+    if strategy == 'nickhost':
+        return nickhost_key(nick, host)
+    if strategy == 'account':
+        return 'legacy:' + host.lower()
+    return host_key(host)
+
+
+def key(strategy, msg):
+    """Returns the voter_key of the sender of 'msg' for 'strategy'
+
+    ::host:: the host of the sender, a nick change is the same voter
+    ::nickhost:: nick and host, voters sharing a cloak or a bouncer are apart
+    ::account:: the services account of the sender when the server tags
+                messages with it, else the bot user they are identified as,
+                else their host"""
+
+    if strategy == 'nickhost':
+        return nickhost_key(msg.nick, msg.host)
+    if strategy == 'account':
+        account = msg.server_tags.get('account')
+        if account:
+            return 'account:' + ircutils.toLower(account)
+        try:
+            return 'user:%s' % ircdb.users.getUserId(msg.prefix)
+        except KeyError:
+            pass
+    return host_key(msg.host)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab: